@@ -17,16 +17,33 @@
 """
 
 import os
+import contextvars
+import cProfile
+import csv
+import io
+import itertools
+import json
 import logging
 import hashlib
+import importlib
+import math
+import queue
+import random
+import socket
+import sqlite3
+import threading
 import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
 from functools import wraps
-from datetime import datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, List, Optional, Iterable, Iterator, Callable
 
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import stripe
@@ -86,6 +103,332 @@ limiter = Limiter(
     storage_uri="memory://"
 )
 
+# ====================================================
+#  Admission Control
+# ====================================================
+# Each route belongs to a priority class with its own concurrency budget.
+# A request waits (up to the class's max wait) while its class is at its
+# limit, the process is at capacity, or a higher-priority request is
+# waiting; after that it is shed with 503 + Retry-After. Webhooks (which
+# move money) outrank health checks, which outrank API calls (which clients
+# can retry), which outrank admin/reporting endpoints.
+#
+# Capacity defaults to the worker's thread count (Gunicorn --threads, which
+# the deploy scripts pass as WORKER_THREADS), since a process cannot serve
+# more requests than it has threads. Each class may also RESERVE slots:
+# a request is only admitted if the slots still free afterwards cover the
+# unused reservations of every higher-priority class. Webhooks, health
+# checks and the API each reserve one slot, so a long admin report or an
+# API burst never takes the last slot a webhook or health check needs.
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))
+ADMISSION_CAPACITY = int(os.getenv("ADMISSION_CAPACITY", str(WORKER_THREADS)))  # per worker process
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))  # seconds
+
+def _admission_class(
+    name: str, priority: int, limit: int, max_wait: float, reserve: int
+) -> Dict[str, Any]:
+    env_prefix = f"ADMISSION_{name.upper()}"
+    return {
+        "priority": priority,
+        "limit": int(os.getenv(f"{env_prefix}_LIMIT", str(limit))),
+        "max_wait": float(os.getenv(f"{env_prefix}_MAX_WAIT", str(max_wait))),
+        "reserve": int(os.getenv(f"{env_prefix}_RESERVE", str(reserve)))
+    }
+
+ADMISSION_CLASSES = {
+    "webhook": _admission_class("webhook", 0, ADMISSION_CAPACITY, 5.0, 1),
+    "health": _admission_class("health", 1, 1, 1.0, 1),
+    "api": _admission_class("api", 2, max(1, ADMISSION_CAPACITY - 2), 0.25, 1),
+    "admin": _admission_class("admin", 3, 1, 0.0, 0),
+}
+
+# Flask endpoint name -> class (anything else is "admin")
+ADMISSION_ROUTES = {
+    "webhook_received": "webhook",
+    "health_check": "health",
+    "metrics": "health",
+    "create_payment_intent": "api",
+}
+
+class AdmissionController:
+    """Per-process priority admission with per-class concurrency budgets"""
+    
+    def __init__(self, capacity: int, classes: Dict[str, Dict[str, Any]]):
+        self.capacity = capacity
+        self.classes = classes
+        for name, config in classes.items():
+            if sum(other["reserve"] for other in classes.values()
+                   if other["priority"] < config["priority"]) >= capacity:
+                logger.warning(f"Admission class {name} can never run: reservations fill capacity {capacity}")
+        self._cond = threading.Condition()
+        self._total = 0
+        self._in_flight = {name: 0 for name in classes}
+        self._waiting = {name: 0 for name in classes}
+        self._stats = {
+            name: {"admitted": 0, "shed": 0, "queue_time_total": 0.0, "queue_time_max": 0.0}
+            for name in classes
+        }
+    
+    def _can_admit(self, name: str) -> bool:
+        priority = self.classes[name]["priority"]
+        # Yield to higher-priority requests that are only waiting for capacity
+        if any(
+            self._waiting[other]
+            and self.classes[other]["priority"] < priority
+            and self._in_flight[other] < self.classes[other]["limit"]
+            for other in self.classes
+        ):
+            return False
+        # Leave room for the unused reservations of higher-priority classes
+        held_back = sum(
+            max(0, self.classes[other]["reserve"] - self._in_flight[other])
+            for other in self.classes
+            if self.classes[other]["priority"] < priority
+        )
+        return (
+            self._total + held_back < self.capacity
+            and self._in_flight[name] < self.classes[name]["limit"]
+        )
+    
+    def acquire(self, name: str) -> bool:
+        """Admit a request of this class, or return False if it must be shed"""
+        started = time.monotonic()
+        deadline = started + self.classes[name]["max_wait"]
+        with self._cond:
+            self._waiting[name] += 1
+            try:
+                while not self._can_admit(name):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats[name]["shed"] += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting[name] -= 1
+                # A departing waiter may unblock lower-priority classes
+                self._cond.notify_all()
+            
+            self._total += 1
+            self._in_flight[name] += 1
+            queue_time = time.monotonic() - started
+            stats = self._stats[name]
+            stats["admitted"] += 1
+            stats["queue_time_total"] += queue_time
+            stats["queue_time_max"] = max(stats["queue_time_max"], queue_time)
+            return True
+    
+    def release(self, name: str) -> None:
+        with self._cond:
+            self._total -= 1
+            self._in_flight[name] -= 1
+            self._cond.notify_all()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Per-class budget, load and queueing-time metrics"""
+        with self._cond:
+            classes = {}
+            for name, config in self.classes.items():
+                stats = self._stats[name]
+                classes[name] = {
+                    "priority": config["priority"],
+                    "limit": config["limit"],
+                    "reserve": config["reserve"],
+                    "in_flight": self._in_flight[name],
+                    "waiting": self._waiting[name],
+                    "admitted": stats["admitted"],
+                    "shed": stats["shed"],
+                    "queue_time_avg_ms": round(
+                        stats["queue_time_total"] / stats["admitted"] * 1000, 3
+                    ) if stats["admitted"] else 0.0,
+                    "queue_time_max_ms": round(stats["queue_time_max"] * 1000, 3)
+                }
+            return {"capacity": self.capacity, "in_flight": self._total, "classes": classes}
+
+admission = AdmissionController(ADMISSION_CAPACITY, ADMISSION_CLASSES)
+
+@app.before_request
+def admit_request() -> Optional[Tuple[Response, int, Dict[str, str]]]:
+    name = ADMISSION_ROUTES.get(request.endpoint, "admin")
+    if not admission.acquire(name):
+        logger.warning(f"Shedding {request.method} {request.path} ({name} class saturated)")
+        return jsonify({"error": "Service temporarily unavailable"}), 503, {
+            "Retry-After": str(ADMISSION_RETRY_AFTER)
+        }
+    g.admission_class = name
+    return None
+
+@app.teardown_request
+def release_request(exc) -> None:
+    name = g.pop("admission_class", None)
+    if name is not None:
+        admission.release(name)
+
+# ====================================================
+#  Profiling & Tracing
+# ====================================================
+# Profiling: a sampled fraction of requests (PROFILE_SAMPLE_RATE), plus any
+# request carrying "X-Ursus-Profile: 1" with a valid X-API-Key, is run under
+# cProfile and the stats are dumped to PROFILE_DIR (.prof files). cProfile
+# only sees the thread that enabled it, so work handed to dispatcher
+# partitions and the transfer pool (@profiled) is profiled on its own thread
+# and written as a separate file with the same request prefix.
+#
+# Tracing: when TRACE_DIR is set, sampled requests record spans for each
+# processing stage and every Stripe call. Each trace is written as a Chrome
+# Trace Event JSON file (load in Perfetto / speedscope for flame graphs).
+# Only the newest TRACE_MAX_FILES traces are kept.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+TRACE_DIR = os.getenv("TRACE_DIR", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_MAX_FILES = int(os.getenv("TRACE_MAX_FILES", "1000"))
+
+# Distinguishes profiles of several calls on the same thread
+_profile_sequence = itertools.count(1)
+
+# Spans of the trace being recorded (None when the request is not traced).
+# Context variables follow work handed to dispatcher partitions.
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("ursus_trace", default=None)
+
+# File prefix of the request being profiled (None when not profiling)
+_current_profile: contextvars.ContextVar = contextvars.ContextVar("ursus_profile", default=None)
+
+# Marks threads that already run a profiler (cProfile cannot nest)
+_profiling_thread = threading.local()
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Record a span for the enclosed block if the current request is traced"""
+    spans = _current_trace.get()
+    if spans is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        spans.append({
+            "name": name,
+            "ph": "X",
+            "ts": int(started * 1_000_000),
+            "dur": int((time.time() - started) * 1_000_000),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": attributes
+        })
+
+def traced(name: str):
+    """Decorator recording a span around every call of the function"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _dump_profile(profiler: cProfile.Profile, name: str) -> None:
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}.prof")
+        profiler.dump_stats(path)
+        logger.info(f"Profile written to {path}")
+    except OSError as e:
+        logger.error(f"Failed to write profile: {e}")
+
+def profiled(name: str):
+    """Decorator profiling the function on its own thread when the request is profiled"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            prefix = _current_profile.get()
+            if prefix is None or getattr(_profiling_thread, "active", False):
+                return f(*args, **kwargs)
+            profiler = cProfile.Profile()
+            _profiling_thread.active = True
+            profiler.enable()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                profiler.disable()
+                _profiling_thread.active = False
+                _dump_profile(
+                    profiler, f"{prefix}-{name}-{threading.get_ident()}-{next(_profile_sequence)}"
+                )
+        return wrapper
+    return decorator
+
+def _profile_requested() -> bool:
+    if request.headers.get("X-Ursus-Profile") == "1":
+        if request.headers.get("X-API-Key") == URSUS_API_KEY:
+            return True
+        logger.warning(f"Unauthenticated profiling request from {request.remote_addr}")
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+@app.before_request
+def start_instrumentation() -> None:
+    if TRACE_DIR and random.random() < TRACE_SAMPLE_RATE:
+        g.trace_started = time.time()
+        g.trace_token = _current_trace.set([])
+    
+    if _profile_requested():
+        prefix = (
+            f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-"
+            f"{request.endpoint or 'unknown'}-{os.getpid()}"
+        )
+        g.profile_token = _current_profile.set(prefix)
+        g.profiler = cProfile.Profile()
+        _profiling_thread.active = True
+        g.profiler.enable()
+
+@app.teardown_request
+def finish_instrumentation(exc) -> None:
+    endpoint = request.endpoint or "unknown"
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        _profiling_thread.active = False
+        token = g.pop("profile_token")
+        _dump_profile(profiler, _current_profile.get())
+        _current_profile.reset(token)
+    
+    token = g.pop("trace_token", None)
+    if token is None:
+        return
+    spans = _current_trace.get()
+    _current_trace.reset(token)
+    started = g.pop("trace_started")
+    spans.append({
+        "name": f"{request.method} {request.path}",
+        "ph": "X",
+        "ts": int(started * 1_000_000),
+        "dur": int((time.time() - started) * 1_000_000),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": {"endpoint": endpoint, "error": repr(exc) if exc else None}
+    })
+    try:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(
+            TRACE_DIR,
+            f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-{endpoint}-{os.getpid()}.json"
+        )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": spans, "displayTimeUnit": "ms"}, f)
+        _prune_traces()
+    except OSError as e:
+        logger.error(f"Failed to write trace: {e}")
+
+def _prune_traces() -> None:
+    """Delete the oldest trace files beyond TRACE_MAX_FILES"""
+    # Names start with a UTC timestamp, so they sort oldest first
+    names = sorted(name for name in os.listdir(TRACE_DIR) if name.endswith(".json"))
+    for name in names[:max(0, len(names) - TRACE_MAX_FILES)]:
+        try:
+            os.remove(os.path.join(TRACE_DIR, name))
+        except FileNotFoundError:
+            pass  # pruned concurrently by another worker
+
 # ====================================================
 #  Fee Configuration
 # ====================================================
@@ -106,6 +449,354 @@ MAX_PAYMENT_AMOUNT = 99999999  # $999,999.99
 # Production: Replace with Redis
 processed_charges = set()
 
+# ====================================================
+#  Shared State Store (SQLite)
+# ====================================================
+# Gunicorn runs several worker processes; state that must be visible to
+# all of them lives in a local SQLite database (WAL mode).
+STATE_DB_PATH = os.getenv("URSUS_STATE_DB", "ursus_state.db")
+
+# DDL statements executed on every new connection (features append here)
+_STATE_SCHEMA: List[str] = []
+
+_state_local = threading.local()
+
+def get_state_db() -> sqlite3.Connection:
+    """Return this thread's connection to the shared state database"""
+    conn = getattr(_state_local, "conn", None)
+    if conn is None or getattr(_state_local, "pid", None) != os.getpid():
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _STATE_SCHEMA:
+            conn.execute(statement)
+        _state_local.conn = conn
+        _state_local.pid = os.getpid()
+    return conn
+
+# ====================================================
+#  PaymentIntent Response Cache
+# ====================================================
+# Client retries with identical parameters are answered from this cache
+# instead of making another Stripe round trip. A row with a NULL response
+# marks a request that is currently in flight; concurrent identical
+# requests wait for it instead of calling Stripe themselves.
+INTENT_CACHE_TTL = int(os.getenv("INTENT_CACHE_TTL", "300"))  # seconds
+INTENT_CACHE_MAX_ENTRIES = int(os.getenv("INTENT_CACHE_MAX_ENTRIES", "10000"))
+INTENT_CACHE_WAIT = float(os.getenv("INTENT_CACHE_WAIT", "10"))  # seconds
+INTENT_CACHE_POLL_INTERVAL = 0.05  # seconds
+
+_STATE_SCHEMA.append("""
+    CREATE TABLE IF NOT EXISTS intent_cache (
+        key TEXT PRIMARY KEY,
+        response TEXT,
+        created_at REAL NOT NULL
+    )
+""")
+_STATE_SCHEMA.append(
+    "CREATE INDEX IF NOT EXISTS intent_cache_created_at ON intent_cache (created_at)"
+)
+
+def claim_intent_cache(key: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """
+    Look up or claim a cache entry for an idempotency key.
+    
+    Returns:
+        (owner, cached_response)
+        - (False, response): a stored response is available
+        - (True, None): caller owns the in-flight call and must store or release
+        - (False, None): cache unavailable or wait timed out; call Stripe directly
+    """
+    deadline = time.time() + INTENT_CACHE_WAIT
+    try:
+        db = get_state_db()
+        while True:
+            now = time.time()
+            # Read-only check first; waiters must not contend for the write lock
+            row = db.execute(
+                "SELECT response, created_at FROM intent_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[0] is not None and row[1] >= now - INTENT_CACHE_TTL:
+                return False, json.loads(row[0])
+            
+            in_flight = row is not None and row[0] is None and row[1] >= now - INTENT_CACHE_WAIT
+            if not in_flight:
+                # Drop the expired response or abandoned claim, then claim
+                if row is not None:
+                    db.execute(
+                        "DELETE FROM intent_cache WHERE key = ? AND created_at = ?", (key, row[1])
+                    )
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO intent_cache (key, response, created_at) "
+                    "VALUES (?, NULL, ?)",
+                    (key, now)
+                )
+                if cursor.rowcount == 1:
+                    return True, None
+                # Another request claimed it first; wait for its response
+                continue
+            
+            if now >= deadline:
+                logger.warning(f"Timed out waiting for in-flight request {key}")
+                return False, None
+            time.sleep(INTENT_CACHE_POLL_INTERVAL)
+    except sqlite3.Error as e:
+        logger.error(f"Intent cache unavailable: {e}")
+        return False, None
+
+def store_intent_cache(key: str, response: Dict[str, Any]) -> None:
+    """Store a successful response and evict the oldest entries over the bound"""
+    try:
+        db = get_state_db()
+        db.execute(
+            "UPDATE intent_cache SET response = ?, created_at = ? WHERE key = ?",
+            (json.dumps(response), time.time(), key)
+        )
+        db.execute(
+            "DELETE FROM intent_cache WHERE key IN ("
+            "SELECT key FROM intent_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (INTENT_CACHE_MAX_ENTRIES,)
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Failed to cache response for {key}: {e}")
+
+def release_intent_cache(key: str) -> None:
+    """Release an in-flight claim so waiting requests retry against Stripe"""
+    try:
+        get_state_db().execute(
+            "DELETE FROM intent_cache WHERE key = ? AND response IS NULL", (key,)
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Failed to release cache claim for {key}: {e}")
+
+# ====================================================
+#  Stripe Circuit Breaker
+# ====================================================
+# Every outbound Stripe call goes through stripe_call(). When the recent
+# error rate (including calls slower than BREAKER_SLOW_CALL_SECONDS) crosses
+# the threshold, the breaker opens and calls fail fast with CircuitOpenError
+# instead of waiting for network timeouts. After BREAKER_OPEN_SECONDS a single
+# half-open probe is let through; its outcome closes or re-opens the breaker.
+# State is kept in the shared state database so all workers agree.
+BREAKER_WINDOW_SECONDS = int(os.getenv("BREAKER_WINDOW_SECONDS", "30"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "5"))
+BREAKER_OPEN_SECONDS = int(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+
+# Errors that indicate Stripe (or the network) is unhealthy. Client errors
+# such as declined cards or invalid requests do not count against Stripe.
+BREAKER_FAILURE_ERRORS = (
+    stripe.error.APIConnectionError,
+    stripe.error.APIError,
+    stripe.error.RateLimitError,
+)
+
+_STATE_SCHEMA.append("""
+    CREATE TABLE IF NOT EXISTS breaker_state (
+        name TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        opened_at REAL NOT NULL DEFAULT 0,
+        probe_started_at REAL NOT NULL DEFAULT 0
+    )
+""")
+_STATE_SCHEMA.append(
+    "INSERT OR IGNORE INTO breaker_state (name, state) VALUES ('stripe', 'closed')"
+)
+# Call outcomes are counted per BREAKER_BUCKET_SECONDS rather than stored
+# per call, so recording one is a single short upsert
+_STATE_SCHEMA.append("""
+    CREATE TABLE IF NOT EXISTS breaker_buckets (
+        bucket INTEGER PRIMARY KEY,
+        calls INTEGER NOT NULL,
+        failures INTEGER NOT NULL
+    )
+""")
+BREAKER_BUCKET_SECONDS = 1
+_breaker_pruned_bucket = 0
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Stripe while the circuit breaker is open"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"Stripe circuit breaker open (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+def _load_breaker_state(db: sqlite3.Connection) -> Tuple[str, float, float]:
+    row = db.execute(
+        "SELECT state, opened_at, probe_started_at FROM breaker_state WHERE name = 'stripe'"
+    ).fetchone()
+    return row or ("closed", 0, 0)
+
+def _breaker_retry_after(since: float, now: float) -> int:
+    return max(1, math.ceil(BREAKER_OPEN_SECONDS - (now - since)))
+
+def _breaker_window(db: sqlite3.Connection, now: float) -> Tuple[int, int]:
+    """(calls, failures) over the last BREAKER_WINDOW_SECONDS"""
+    return db.execute(
+        "SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(failures), 0) "
+        "FROM breaker_buckets WHERE bucket >= ?",
+        ((now - BREAKER_WINDOW_SECONDS) // BREAKER_BUCKET_SECONDS,)
+    ).fetchone()
+
+def breaker_before_call() -> bool:
+    """
+    Check the breaker before a Stripe call.
+    
+    Only reads while the breaker is closed (or open and cooling down); the
+    write lock is taken just to move an expired open breaker to half-open.
+    
+    Returns:
+        True if this call is the half-open probe
+    
+    Raises:
+        CircuitOpenError: if the call must fail fast
+    """
+    now = time.time()
+    try:
+        db = get_state_db()
+        state, opened_at, probe_started_at = _load_breaker_state(db)
+        if state == "closed":
+            return False
+        if state == "open" and now - opened_at < BREAKER_OPEN_SECONDS:
+            raise CircuitOpenError(_breaker_retry_after(opened_at, now))
+        if state == "half_open" and now - probe_started_at < BREAKER_OPEN_SECONDS:
+            raise CircuitOpenError(_breaker_retry_after(probe_started_at, now))
+        
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-check: another worker may have sent the probe already
+            state, opened_at, probe_started_at = _load_breaker_state(db)
+            
+            if state == "closed":
+                return False
+            
+            if state == "open" and now - opened_at < BREAKER_OPEN_SECONDS:
+                raise CircuitOpenError(_breaker_retry_after(opened_at, now))
+            
+            # Half-open: allow one probe at a time (re-issue if a probe got lost)
+            if state == "half_open" and now - probe_started_at < BREAKER_OPEN_SECONDS:
+                raise CircuitOpenError(_breaker_retry_after(probe_started_at, now))
+            
+            db.execute(
+                "UPDATE breaker_state SET state = 'half_open', probe_started_at = ? "
+                "WHERE name = 'stripe'",
+                (now,)
+            )
+            logger.warning("Stripe circuit breaker half-open - sending probe")
+            return True
+        finally:
+            db.execute("COMMIT")
+    except sqlite3.Error as e:
+        # Never block payments because the breaker store is unavailable
+        logger.error(f"Circuit breaker state unavailable: {e}")
+        return False
+
+def breaker_record(ok: bool, is_probe: bool) -> None:
+    """Record the outcome of a Stripe call and trip or reset the breaker"""
+    now = time.time()
+    try:
+        db = get_state_db()
+        if is_probe:
+            if ok:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    db.execute("DELETE FROM breaker_buckets")
+                    db.execute(
+                        "UPDATE breaker_state SET state = 'closed' WHERE name = 'stripe'"
+                    )
+                finally:
+                    db.execute("COMMIT")
+                logger.info("Stripe circuit breaker closed - probe succeeded")
+            else:
+                db.execute(
+                    "UPDATE breaker_state SET state = 'open', opened_at = ? "
+                    "WHERE name = 'stripe'",
+                    (now,)
+                )
+                logger.error("Stripe circuit breaker re-opened - probe failed")
+            return
+        
+        bucket = int(now // BREAKER_BUCKET_SECONDS)
+        db.execute(
+            "INSERT INTO breaker_buckets (bucket, calls, failures) VALUES (?, 1, ?) "
+            "ON CONFLICT (bucket) DO UPDATE SET "
+            "calls = calls + 1, failures = failures + excluded.failures",
+            (bucket, int(not ok))
+        )
+        # Prune old buckets once per bucket per process, and on failures
+        global _breaker_pruned_bucket
+        if bucket != _breaker_pruned_bucket or not ok:
+            _breaker_pruned_bucket = bucket
+            db.execute(
+                "DELETE FROM breaker_buckets WHERE bucket < ?",
+                ((now - BREAKER_WINDOW_SECONDS) // BREAKER_BUCKET_SECONDS,)
+            )
+        if ok:
+            return
+        
+        total, failures = _breaker_window(db, now)
+        if total < BREAKER_MIN_CALLS or failures / total < BREAKER_ERROR_RATE:
+            return
+        cursor = db.execute(
+            "UPDATE breaker_state SET state = 'open', opened_at = ? "
+            "WHERE name = 'stripe' AND state = 'closed'",
+            (now,)
+        )
+        if cursor.rowcount == 1:
+            logger.error(
+                f"Stripe circuit breaker opened: {failures}/{total} calls failed "
+                f"in the last {BREAKER_WINDOW_SECONDS}s"
+            )
+    except sqlite3.Error as e:
+        logger.error(f"Failed to record Stripe call outcome: {e}")
+
+def breaker_status() -> Dict[str, Any]:
+    """Current breaker state for health reporting"""
+    now = time.time()
+    try:
+        db = get_state_db()
+        state, opened_at, _ = _load_breaker_state(db)
+        total, failures = _breaker_window(db, now)
+    except sqlite3.Error as e:
+        logger.error(f"Circuit breaker state unavailable: {e}")
+        return {"state": "unknown"}
+    
+    status = {"state": state, "recent_calls": total, "recent_failures": failures}
+    if state == "open" and now - opened_at < BREAKER_OPEN_SECONDS:
+        status["retry_after"] = _breaker_retry_after(opened_at, now)
+    return status
+
+def stripe_call(func, *args, **kwargs):
+    """Call a Stripe SDK function through the circuit breaker"""
+    is_probe = breaker_before_call()
+    started = time.monotonic()
+    try:
+        with trace_span(f"stripe.{func.__qualname__}"):
+            result = func(*args, **kwargs)
+    except BREAKER_FAILURE_ERRORS:
+        breaker_record(False, is_probe)
+        raise
+    except Exception:
+        breaker_record(True, is_probe)
+        raise
+    breaker_record(time.monotonic() - started < BREAKER_SLOW_CALL_SECONDS, is_probe)
+    return result
+
+def stripe_list(resource, **params) -> Iterator:
+    """
+    Iterate over every object of a Stripe list call.
+    
+    Paginates by hand rather than with auto_paging_iter so that every page
+    goes through stripe_call (breaker and trace span).
+    """
+    while True:
+        page = stripe_call(resource.list, **params)
+        yield from page.data
+        if not page.has_more or not page.data:
+            return
+        params["starting_after"] = page.data[-1]["id"]
+
 # ====================================================
 #  Authentication Decorator
 # ====================================================
@@ -129,6 +820,7 @@ def require_api_key(f):
 # ====================================================
 #  Fee Calculation Functions
 # ====================================================
+@traced("calculate_fees")
 def calculate_fees(amount_cents: int) -> Dict[str, int]:
     """
     Calculate fee breakdown for a payment.
@@ -215,13 +907,15 @@ def create_payment_intent() -> Tuple[Response, int]:
         customer_email: (optional) Customer email for receipt
     """
     try:
-        data = request.get_json(force=True)
+        with trace_span("parse_json"):
+            data = request.get_json(force=True)
     except Exception as e:
         logger.error(f"Invalid JSON payload: {e}")
         return jsonify({"error": "Invalid JSON"}), 400
     
     # Validate amount
-    is_valid, error_msg, amount = validate_payment_amount(data.get("amount"))
+    with trace_span("validate_amount"):
+        is_valid, error_msg, amount = validate_payment_amount(data.get("amount"))
     if not is_valid:
         logger.warning(f"Invalid payment amount from {request.remote_addr}: {error_msg}")
         return jsonify({"error": error_msg}), 400
@@ -231,6 +925,7 @@ def create_payment_intent() -> Tuple[Response, int]:
     
     # Generate order ID if not provided
     order_id = data.get("order_id")
+    order_id_provided = bool(order_id)
     if not order_id:
         order_id = f"ORD-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
     
@@ -241,8 +936,30 @@ def create_payment_intent() -> Tuple[Response, int]:
     if customer_email and len(customer_email) > 200:
         customer_email = customer_email[:200]
     
+    idempotency_key = hashlib.sha256(f"{order_id}-{amount}".encode()).hexdigest()[:24]
+    
+    # Serve client retries from the cache (or wait for an identical in-flight request).
+    # The cache key covers every parameter sent to Stripe, so a reused order ID
+    # with different parameters still reaches Stripe (which rejects it).
+    # Generated order IDs identify no client retry and are never cached.
+    cache_key = hashlib.sha256(json.dumps(
+        [idempotency_key, order_id, amount, customer_email]
+    ).encode()).hexdigest()
+    cache_owner, cached_response = False, None
+    if order_id_provided:
+        with trace_span("intent_cache.claim"):
+            cache_owner, cached_response = claim_intent_cache(cache_key)
+    if cached_response is not None:
+        logger.info(
+            f"PaymentIntent {cached_response['payment_intent_id']} served from cache "
+            f"(order: {order_id})"
+        )
+        return jsonify(cached_response), 200
+    cache_stored = False
+    
     try:
-        intent = stripe.PaymentIntent.create(
+        intent = stripe_call(
+            stripe.PaymentIntent.create,
             amount=amount,
             currency="usd",
             automatic_payment_methods={
@@ -258,12 +975,13 @@ def create_payment_intent() -> Tuple[Response, int]:
             },
             receipt_email=customer_email if customer_email else None,
             statement_descriptor_suffix="URSUS",
-            idempotency_key=hashlib.sha256(f"{order_id}-{amount}".encode()).hexdigest()[:24]
+            idempotency_key=idempotency_key
         )
         
-        logger.info(f"PaymentIntent created: {intent.id} for ${amount/100:.2f} (order: {order_id})")
+        with trace_span("log"):
+            logger.info(f"PaymentIntent created: {intent.id} for ${amount/100:.2f} (order: {order_id})")
         
-        return jsonify({
+        response_body = {
             "client_secret": intent.client_secret,
             "payment_intent_id": intent.id,
             "amount": amount,
@@ -272,8 +990,20 @@ def create_payment_intent() -> Tuple[Response, int]:
                 "platform_commission": fees["platform_commission"],
                 "transfer_to_connected": fees["transfer_amount"]
             }
-        }), 200
+        }
+        if cache_owner:
+            with trace_span("intent_cache.store"):
+                store_intent_cache(cache_key, response_body)
+            cache_stored = True
+        
+        return jsonify(response_body), 200
         
+    except CircuitOpenError as e:
+        logger.warning(f"Rejecting payment request: {e}")
+        return jsonify({"error": "Service temporarily unavailable"}), 503, {
+            "Retry-After": str(e.retry_after)
+        }
+    
     except stripe.error.CardError as e:
         logger.warning(f"Card error: {e.user_message}")
         return jsonify({"error": "Card declined"}), 400
@@ -297,6 +1027,171 @@ def create_payment_intent() -> Tuple[Response, int]:
     except Exception as e:
         logger.exception(f"Unexpected error in create_payment_intent: {e}")
         return jsonify({"error": "Internal server error"}), 500
+    
+    finally:
+        if cache_owner and not cache_stored:
+            release_intent_cache(cache_key)
+
+# ====================================================
+#  Webhook Event Dispatcher
+# ====================================================
+# Events are hashed on charge ID into ordered partitions, each drained by its
+# own worker thread. Within a worker process, events for the same charge
+# (succeeded / captured / refunded) are processed in arrival order while
+# different charges proceed in parallel.
+#
+# Partitions are per process. Across the Gunicorn workers of one server,
+# events for a charge are serialized (not ordered) by a per-charge lock in
+# the shared state database; across servers, transfers are protected by
+# charge ownership leases. The /webhook request thread waits for its event,
+# so partitions provide ordering, not throughput: webhook concurrency stays
+# bounded by Gunicorn's threads, and all partitions share one process (and
+# its GIL). Nothing slow that is not charge work may run on a partition.
+WEBHOOK_PARTITIONS = int(os.getenv("WEBHOOK_PARTITIONS", "8"))
+WEBHOOK_DISPATCH_TIMEOUT = float(os.getenv("WEBHOOK_DISPATCH_TIMEOUT", "25"))  # seconds
+CHARGE_LOCK_WAIT = float(os.getenv("CHARGE_LOCK_WAIT", "10"))  # seconds
+CHARGE_LOCK_STALE_SECONDS = 300  # locks left behind by a crashed worker
+CHARGE_LOCK_POLL_INTERVAL = 0.05  # seconds
+CAPTURE_SETTLE_SECONDS = 2  # wait after charge.captured before transferring
+
+_STATE_SCHEMA.append("""
+    CREATE TABLE IF NOT EXISTS charge_locks (
+        charge_id TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        acquired_at REAL NOT NULL
+    )
+""")
+
+class ChargeBusyError(Exception):
+    """Raised when another worker process keeps a charge locked too long"""
+    
+    def __init__(self, charge_id: str, retry_after: int):
+        super().__init__(f"Charge {charge_id} is being processed by another worker")
+        self.retry_after = retry_after
+
+@contextmanager
+def charge_lock(charge_id: str):
+    """Serialize processing of one charge across the worker processes of this server"""
+    owner = f"{os.getpid()}:{threading.get_ident()}"
+    deadline = time.time() + CHARGE_LOCK_WAIT
+    locked = False
+    try:
+        db = get_state_db()
+        while True:
+            now = time.time()
+            db.execute(
+                "DELETE FROM charge_locks WHERE charge_id = ? AND acquired_at < ?",
+                (charge_id, now - CHARGE_LOCK_STALE_SECONDS)
+            )
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO charge_locks (charge_id, owner, acquired_at) "
+                "VALUES (?, ?, ?)",
+                (charge_id, owner, now)
+            )
+            if cursor.rowcount == 1:
+                locked = True
+                break
+            if now >= deadline:
+                raise ChargeBusyError(charge_id, 1)
+            time.sleep(CHARGE_LOCK_POLL_INTERVAL)
+    except sqlite3.Error as e:
+        # Fall back to idempotency protection alone
+        logger.error(f"Charge lock unavailable for {charge_id}: {e}")
+    
+    try:
+        yield
+    finally:
+        if locked:
+            try:
+                get_state_db().execute(
+                    "DELETE FROM charge_locks WHERE charge_id = ? AND owner = ?",
+                    (charge_id, owner)
+                )
+            except sqlite3.Error as e:
+                logger.error(f"Failed to release charge lock for {charge_id}: {e}")
+
+class PartitionedDispatcher:
+    """Runs tasks on N ordered partitions selected by a stable key hash"""
+    
+    def __init__(self, partitions: int, name: str):
+        self.name = name
+        self.partitions = max(1, partitions)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queues: List[queue.Queue] = []
+        self._processed: List[int] = []
+        self._busy: List[bool] = []
+    
+    def _ensure_started(self) -> None:
+        # Workers are started lazily so each forked Gunicorn worker owns its threads
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [queue.Queue() for _ in range(self.partitions)]
+            self._processed = [0] * self.partitions
+            self._busy = [False] * self.partitions
+            for index in range(self.partitions):
+                threading.Thread(
+                    target=self._worker,
+                    args=(index,),
+                    name=f"{self.name}-{index}",
+                    daemon=True
+                ).start()
+            self._pid = os.getpid()
+    
+    def partition_for(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % self.partitions
+    
+    def submit(self, key: str, func, *args) -> Future:
+        """Queue func(*args) on the partition owning key"""
+        self._ensure_started()
+        future = Future()
+        context = contextvars.copy_context()
+        self._queues[self.partition_for(key)].put((future, context.run, (func,) + args))
+        return future
+    
+    def _worker(self, index: int) -> None:
+        work_queue = self._queues[index]
+        while True:
+            future, func, args = work_queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._busy[index] = True
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._busy[index] = False
+                self._processed[index] += 1
+    
+    def stats(self) -> List[Dict[str, Any]]:
+        """Per-partition queue depth and throughput"""
+        if self._pid != os.getpid():
+            return []
+        return [
+            {
+                "partition": index,
+                "depth": self._queues[index].qsize(),
+                "busy": self._busy[index],
+                "processed": self._processed[index]
+            }
+            for index in range(self.partitions)
+        ]
+
+webhook_dispatcher = PartitionedDispatcher(WEBHOOK_PARTITIONS, "webhook-partition")
+
+def event_partition_key(event: Dict[str, Any]) -> str:
+    """Charge ID an event belongs to (falls back to the object or event ID)"""
+    obj = event["data"]["object"]
+    if obj.get("object") == "payment_intent":
+        latest_charge = obj.get("latest_charge")
+        if isinstance(latest_charge, dict):
+            latest_charge = latest_charge.get("id")
+        return latest_charge or obj.get("id") or event.get("id", "")
+    return obj.get("id") or event.get("id", "")
 
 # ====================================================
 #  Stripe Webhook Endpoint
@@ -306,7 +1201,8 @@ def create_payment_intent() -> Tuple[Response, int]:
 def webhook_received() -> Tuple[str, int]:
     """
     Handles Stripe webhook events.
-    Processes charge.succeeded and charge.refunded events.
+    Processes charge.succeeded, charge.captured, charge.refunded and
+    payment_intent.succeeded events.
     """
     payload = request.data
     sig_header = request.headers.get("Stripe-Signature")
@@ -317,9 +1213,10 @@ def webhook_received() -> Tuple[str, int]:
     
     # Verify webhook signature
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, WEBHOOK_SECRET
-        )
+        with trace_span("verify_signature"):
+            event = stripe.Webhook.construct_event(
+                payload, sig_header, WEBHOOK_SECRET
+            )
     except stripe.error.SignatureVerificationError as e:
         logger.error(f"Invalid webhook signature: {e}")
         return "Invalid signature", 400
@@ -330,8 +1227,53 @@ def webhook_received() -> Tuple[str, int]:
         logger.exception(f"Webhook verification error: {e}")
         return "Webhook error", 400
     
+    logger.info(f"Received webhook: {event.get('type')} (ID: {event.get('id')})")
+    
+    if event.get("type") == "charge.captured":
+        # Small delay to ensure Stripe has fully processed the capture. Done
+        # here so it only holds this request thread, not the charge's partition
+        logger.info(f"Waiting {CAPTURE_SETTLE_SECONDS} seconds for Stripe to finalize capture...")
+        time.sleep(CAPTURE_SETTLE_SECONDS)
+    
+    future = webhook_dispatcher.submit(event_partition_key(event), process_webhook_event, event)
+    try:
+        with trace_span("dispatch_wait"):
+            future.result(timeout=WEBHOOK_DISPATCH_TIMEOUT)
+    except CircuitOpenError as e:
+        # Let Stripe redeliver the event once the breaker allows calls again
+        logger.warning(f"Deferring webhook {event.get('id')}: {e}")
+        return "Service temporarily unavailable", 503, {"Retry-After": str(e.retry_after)}
+    except LeaseHeldError as e:
+        # Another worker owns this charge; redelivery lets it finish or expire
+        logger.info(f"Deferring webhook {event.get('id')}: {e}")
+        return "Charge being processed elsewhere", 503, {"Retry-After": str(e.retry_after)}
+    except ChargeBusyError as e:
+        logger.info(f"Deferring webhook {event.get('id')}: {e}")
+        return "Charge being processed elsewhere", 503, {"Retry-After": str(e.retry_after)}
+    except FutureTimeoutError:
+        # Still queued or running; a redelivery is safe thanks to idempotency
+        logger.warning(f"Webhook {event.get('id')} not processed within {WEBHOOK_DISPATCH_TIMEOUT}s")
+        return "Processing timeout", 503
+    
+    return "OK", 200
+
+@traced("process_webhook_event")
+@profiled("process_webhook_event")
+def process_webhook_event(event: Dict[str, Any]) -> None:
+    """
+    Process a verified webhook event under its charge lock.
+    Runs on the event's dispatcher partition.
+    """
+    with charge_lock(event_partition_key(event)):
+        route_webhook_event(event)
+
+def route_webhook_event(event: Dict[str, Any]) -> None:
+    """Route a verified webhook event to its handler"""
     event_type = event.get("type")
-    logger.info(f"Received webhook: {event_type} (ID: {event.get('id')})")
+    
+    # Keep the freshest copy of every charge we are told about
+    if event_type and event_type.startswith("charge."):
+        charge_cache.put(event["data"]["object"]["id"], event["data"]["object"])
     
     # Process charge.succeeded events (only if captured)
     if event_type == "charge.succeeded":
@@ -344,11 +1286,13 @@ def webhook_received() -> Tuple[str, int]:
     
     # Process charge.captured events (for manually captured charges)
     elif event_type == "charge.captured":
-        # Small delay to ensure Stripe has fully processed the capture
-        logger.info("Waiting 2 seconds for Stripe to finalize capture...")
-        time.sleep(2)
+        # webhook_received has already waited CAPTURE_SETTLE_SECONDS
         handle_charge_succeeded(event)  # Process the transfer
     
+    # Process payment_intent.succeeded events (transfer for the latest charge)
+    elif event_type == "payment_intent.succeeded":
+        handle_payment_intent_succeeded(event)
+    
     # Process charge.refunded events
     elif event_type == "charge.refunded":
         handle_charge_refunded(event)
@@ -356,8 +1300,61 @@ def webhook_received() -> Tuple[str, int]:
     # Log other events for monitoring
     else:
         logger.debug(f"Unhandled event type: {event_type}")
+
+# ====================================================
+#  Charge Object Cache
+# ====================================================
+# Short-lived, per-process cache of charge objects. Charges delivered in
+# webhook events and charges fetched from Stripe are both stored, so
+# related events (payment_intent.succeeded, refunds) avoid extra retrieves.
+CHARGE_CACHE_TTL = int(os.getenv("CHARGE_CACHE_TTL", "120"))  # seconds
+CHARGE_CACHE_MAX_ENTRIES = int(os.getenv("CHARGE_CACHE_MAX_ENTRIES", "1000"))
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds"""
     
-    return "OK", 200
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+charge_cache = TTLCache(CHARGE_CACHE_TTL, CHARGE_CACHE_MAX_ENTRIES)
+
+def get_charge(charge_id: str, require_captured: bool = False) -> Any:
+    """
+    Return a charge from the cache, retrieving it from Stripe on a miss.
+    
+    Args:
+        charge_id: Charge to look up
+        require_captured: Treat a cached uncaptured charge as stale
+    """
+    charge = charge_cache.get(charge_id)
+    if charge is not None and (charge.get("captured", False) or not require_captured):
+        return charge
+    
+    charge = stripe_call(stripe.Charge.retrieve, charge_id)
+    charge_cache.put(charge_id, charge)
+    return charge
 
 # ====================================================
 #  Payment Intent Success Handler
@@ -366,112 +1363,938 @@ def handle_payment_intent_succeeded(event: Dict[str, Any]) -> None:
     """
     Process payment_intent.succeeded events (alternative to charge.succeeded).
     This fires when payment is captured via PaymentIntent API.
+    
+    Uses latest_charge directly when it is expanded, otherwise the charge
+    cache; Stripe is only asked for the charge on a cache miss, and not at
+    all once the charge's transfers have completed.
     """
     payment_intent = event["data"]["object"]
     
-    # Get the charge ID from the payment intent
-    charge_id = payment_intent.get("latest_charge")
+    # Get the charge (ID or expanded object) from the payment intent
+    latest_charge = payment_intent.get("latest_charge")
     
-    if not charge_id:
+    if not latest_charge:
         logger.warning(f"PaymentIntent {payment_intent['id']} succeeded but no charge found")
         return
     
-    # Retrieve the charge to get full details
+    charge_id = latest_charge if isinstance(latest_charge, str) else latest_charge["id"]
+    
+    # charge.succeeded usually arrives first; skip the retrieve when it did
+    if charge_already_transferred(charge_id):
+        logger.info(f"Charge {charge_id} from PaymentIntent already processed, skipping")
+        return
+    
     try:
-        charge = stripe.Charge.retrieve(charge_id)
+        if isinstance(latest_charge, str):
+            charge = get_charge(charge_id, require_captured=True)
+        else:
+            charge = latest_charge
+            charge_cache.put(charge_id, charge)
         
         # Only process if captured
         if not charge.get("captured", False):
             logger.info(f"Skipping uncaptured charge {charge_id} from PaymentIntent")
             return
         
-        # Create a charge event structure for handle_charge_succeeded
-        charge_event = {
-            "data": {
-                "object": charge
-            }
-        }
-        
-        # Small delay to ensure Stripe processes everything
-        logger.info("Waiting 2 seconds for Stripe to finalize...")
-        time.sleep(2)
-        
         # Process the transfer
-        handle_charge_succeeded(charge_event)
+        handle_charge_succeeded({"data": {"object": charge}})
         
+    except (CircuitOpenError, LeaseHeldError):
+        raise
     except stripe.error.StripeError as e:
         logger.error(f"Failed to retrieve charge {charge_id}: {e}")
     except Exception as e:
         logger.exception(f"Unexpected error in handle_payment_intent_succeeded: {e}")
 
+# ====================================================
+#  Split Payout Rules
+# ====================================================
+# The net transfer amount of a charge can be divided across several
+# Connected Accounts. Rules come from the charge's "splits" metadata (a JSON
+# string) or, failing that, the SPLIT_RULES environment variable, e.g.:
+#
+#   [{"destination": "acct_A", "amount": 500},
+#    {"destination": "acct_B", "percent": "60"},
+#    {"destination": "acct_C", "percent": "40"}]
+#
+# Fixed amounts (cents) are taken first; percentages (summing to 100) divide
+# the remainder using largest-remainder rounding, so legs always add up to
+# the net amount exactly. Without rules, everything goes to
+# CONNECTED_ACCOUNT_ID as before.
+SPLIT_RULES = os.getenv("SPLIT_RULES", "")
+TRANSFER_POOL_SIZE = int(os.getenv("TRANSFER_POOL_SIZE", "8"))
+
+transfer_pool = ThreadPoolExecutor(max_workers=TRANSFER_POOL_SIZE, thread_name_prefix="transfer")
+
+def get_split_rules(charge: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Split rules for a charge (metadata first, then configuration).
+    
+    Raises:
+        ValueError: if the rules are not valid JSON
+    """
+    raw = (charge.get("metadata") or {}).get("splits") or SPLIT_RULES
+    if not raw:
+        return [{"destination": CONNECTED_ACCOUNT_ID, "percent": "100"}]
+    try:
+        rules = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid split rules JSON: {e}")
+    if not isinstance(rules, list) or not rules:
+        raise ValueError("Split rules must be a non-empty list")
+    return rules
+
+def _split_number(value: Any, integral: bool) -> Decimal:
+    """Parse a split amount or percent, rejecting anything but finite numbers"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{value!r} is not a number")
+    try:
+        number = Decimal(str(value))
+    except ArithmeticError:
+        raise ValueError(f"{value!r} is not a number")
+    if not number.is_finite():
+        raise ValueError(f"{value!r} is not a finite number")
+    if integral and number != number.to_integral_value():
+        raise ValueError(f"{value!r} is not a whole number of cents")
+    return number
+
+def allocate_splits(total: int, rules: List[Dict[str, Any]]) -> List[Tuple[str, int]]:
+    """
+    Divide total cents across split rules, exact to the cent.
+    
+    Returns:
+        [(destination, amount)] in rule order, zero-amount legs omitted
+    
+    Raises:
+        ValueError: if the rules are invalid or cannot cover total exactly
+    """
+    amounts = [0] * len(rules)
+    percents = {}
+    for index, rule in enumerate(rules):
+        destination = rule.get("destination", "") if isinstance(rule, dict) else ""
+        if not str(destination).startswith("acct_"):
+            raise ValueError(f"Split rule {index + 1} has no valid destination account")
+        if ("amount" in rule) == ("percent" in rule):
+            raise ValueError(f"Split rule {index + 1} needs exactly one of 'amount' or 'percent'")
+        try:
+            if "amount" in rule:
+                amounts[index] = int(_split_number(rule["amount"], integral=True))
+            else:
+                percents[index] = _split_number(rule["percent"], integral=False)
+        except ValueError as e:
+            raise ValueError(f"Split rule {index + 1} has an invalid amount or percent: {e}")
+        if amounts[index] < 0 or percents.get(index, 0) < 0:
+            raise ValueError(f"Split rule {index + 1} is negative")
+    
+    remaining = total - sum(amounts)
+    if remaining < 0:
+        raise ValueError(f"Fixed split amounts exceed the net amount ({total} cents)")
+    
+    if not percents:
+        if remaining != 0:
+            raise ValueError(f"Fixed split amounts do not add up to the net amount ({total} cents)")
+    else:
+        if sum(percents.values()) != 100:
+            raise ValueError("Split percentages must add up to 100")
+        # Largest-remainder rounding: floor every share, then hand out the
+        # leftover cents to the largest fractional parts (earlier rules win ties)
+        shares = {index: Decimal(remaining) * percent / 100 for index, percent in percents.items()}
+        for index, share in shares.items():
+            amounts[index] = int(share)
+        leftover = remaining - sum(amounts[index] for index in shares)
+        by_fraction = sorted(shares, key=lambda index: (-(shares[index] - int(shares[index])), index))
+        for index in by_fraction[:leftover]:
+            amounts[index] += 1
+    
+    return [
+        (rules[index]["destination"], amount)
+        for index, amount in enumerate(amounts) if amount > 0
+    ]
+
+def transfer_idempotency_key(charge_id: str, leg: int, leg_count: int, destination: str) -> str:
+    """Idempotency key per transfer leg (single-destination charges keep the original key)"""
+    if leg_count == 1:
+        return f"transfer_{charge_id}"
+    return f"transfer_{charge_id}_{leg}_{destination}"
+
+def split_dead_letter_key(charge_id: str) -> str:
+    """Dead-letter key for a charge whose split rules were invalid (no legs issued)"""
+    return f"splits_{charge_id}"
+
+# ====================================================
+#  Charge Ownership Leases
+# ====================================================
+# When several nodes run the gateway, each charge's transfer is owned by one
+# worker at a time through a lease in a coordination store. Other workers
+# answer the webhook with 503 so Stripe redelivers it later; if the owner
+# dies, its lease expires and the next delivery takes over. Completed
+# charges are remembered so redeliveries on any node are skipped.
+#
+# A transfer can outlast the lease (each Stripe call may take up to the
+# client's network timeout), so the owner renews it every third of the TTL
+# while legs are in flight.
+#
+# Stores: "sqlite" (a database file on storage shared by all nodes),
+# "local" (in-process stand-in for single-node setups and development), or
+# "package.module:ClassName" for a custom implementation.
+COORDINATION_STORE = os.getenv("COORDINATION_STORE", "sqlite")
+COORDINATION_DB = os.getenv("COORDINATION_DB", "ursus_coordination.db")
+TRANSFER_LEASE_SECONDS = int(os.getenv("TRANSFER_LEASE_SECONDS", "60"))
+TRANSFER_LEASE_RENEW_SECONDS = TRANSFER_LEASE_SECONDS / 3
+LEASE_RETENTION_SECONDS = int(os.getenv("LEASE_RETENTION_DAYS", "7")) * 86400
+NODE_NAME = os.getenv("NODE_NAME", socket.gethostname())
+
+class LeaseHeldError(Exception):
+    """Raised when another worker currently owns a charge's transfer"""
+    
+    def __init__(self, key: str, retry_after: int):
+        super().__init__(f"Lease {key} held by another worker (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+class CoordinationStore:
+    """
+    Lease storage interface.
+    
+    acquire() returns ("acquired" | "held" | "completed", seconds_until_expiry).
+    """
+    
+    def acquire(self, key: str, owner: str, ttl: int) -> Tuple[str, float]:
+        raise NotImplementedError
+    
+    def release(self, key: str, owner: str, completed: bool = False) -> None:
+        raise NotImplementedError
+    
+    def renew(self, key: str, owner: str, ttl: int) -> bool:
+        """Extend owner's lease by ttl; False if owner no longer holds it"""
+        raise NotImplementedError
+    
+    def is_completed(self, key: str) -> bool:
+        """Whether key was released as completed (False if unknown)"""
+        return False
+
+class LocalCoordinationStore(CoordinationStore):
+    """In-process leases (one node, one worker process)"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._completed: Dict[str, float] = {}
+    
+    def acquire(self, key: str, owner: str, ttl: int) -> Tuple[str, float]:
+        now = time.time()
+        with self._lock:
+            if key in self._completed:
+                return "completed", 0
+            holder, expires_at = self._leases.get(key, (owner, 0))
+            if holder != owner and expires_at > now:
+                return "held", expires_at - now
+            self._leases[key] = (owner, now + ttl)
+            return "acquired", ttl
+    
+    def release(self, key: str, owner: str, completed: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            if self._leases.get(key, (None, 0))[0] == owner:
+                del self._leases[key]
+            else:
+                logger.warning(f"Lease {key} was taken over before {owner} released it")
+            if completed:
+                self._completed[key] = now
+                for done_key, completed_at in list(self._completed.items()):
+                    if completed_at < now - LEASE_RETENTION_SECONDS:
+                        del self._completed[done_key]
+    
+    def renew(self, key: str, owner: str, ttl: int) -> bool:
+        with self._lock:
+            if self._leases.get(key, (None, 0))[0] != owner:
+                return False
+            self._leases[key] = (owner, time.time() + ttl)
+            return True
+    
+    def is_completed(self, key: str) -> bool:
+        with self._lock:
+            return key in self._completed
+
+class SQLiteCoordinationStore(CoordinationStore):
+    """
+    Leases in a SQLite file shared by all nodes.
+    
+    Uses a rollback journal rather than WAL, since WAL does not work on
+    network filesystems. Lease expiry relies on node clocks being in sync.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+    
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    completed_at REAL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS leases_completed_at ON leases (completed_at)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    def acquire(self, key: str, owner: str, ttl: int) -> Tuple[str, float]:
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT owner, expires_at, completed_at FROM leases WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[2] is not None:
+                return "completed", 0
+            if row and row[0] != owner and row[1] > now:
+                return "held", row[1] - now
+            db.execute(
+                "INSERT OR REPLACE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                (key, owner, now + ttl)
+            )
+            if row:
+                logger.warning(f"Took over expired lease {key} from {row[0]}")
+            return "acquired", ttl
+        finally:
+            db.execute("COMMIT")
+    
+    def release(self, key: str, owner: str, completed: bool = False) -> None:
+        now = time.time()
+        db = self._db()
+        if completed:
+            cursor = db.execute(
+                "UPDATE leases SET completed_at = ?, expires_at = 0 WHERE key = ? AND owner = ?",
+                (now, key, owner)
+            )
+            db.execute(
+                "DELETE FROM leases WHERE completed_at < ?", (now - LEASE_RETENTION_SECONDS,)
+            )
+        else:
+            cursor = db.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+        if cursor.rowcount == 0:
+            logger.warning(f"Lease {key} was taken over before {owner} released it")
+    
+    def renew(self, key: str, owner: str, ttl: int) -> bool:
+        cursor = self._db().execute(
+            "UPDATE leases SET expires_at = ? "
+            "WHERE key = ? AND owner = ? AND completed_at IS NULL",
+            (time.time() + ttl, key, owner)
+        )
+        return cursor.rowcount == 1
+    
+    def is_completed(self, key: str) -> bool:
+        row = self._db().execute(
+            "SELECT completed_at FROM leases WHERE key = ?", (key,)
+        ).fetchone()
+        return bool(row and row[0] is not None)
+
+def create_coordination_store(kind: str) -> CoordinationStore:
+    """Build the configured coordination store"""
+    if kind == "sqlite":
+        return SQLiteCoordinationStore(COORDINATION_DB)
+    if kind == "local":
+        return LocalCoordinationStore()
+    if ":" in kind:
+        module_name, class_name = kind.split(":", 1)
+        return getattr(importlib.import_module(module_name), class_name)()
+    raise RuntimeError(f"Unknown COORDINATION_STORE: {kind}")
+
+coordination_store = create_coordination_store(COORDINATION_STORE)
+
+def lease_owner() -> str:
+    """Identity of this worker process across the cluster"""
+    return f"{NODE_NAME}:{os.getpid()}"
+
+def transfer_lease_key(charge_id: str) -> str:
+    return f"transfer:{charge_id}"
+
+def charge_already_transferred(charge_id: str) -> bool:
+    """
+    Whether this or any other worker has completed the charge's transfers.
+    
+    Does not take the lease, so it is safe to call before fetching the charge.
+    """
+    if charge_id in processed_charges:
+        return True
+    try:
+        if coordination_store.is_completed(transfer_lease_key(charge_id)):
+            processed_charges.add(charge_id)
+            return True
+    except Exception as e:
+        logger.error(f"Coordination store unavailable for {charge_id}: {e}")
+    return False
+
 # ====================================================
 #  Charge Success Handler
 # ====================================================
 def handle_charge_succeeded(event: Dict[str, Any]) -> None:
-    """Process successful charge and transfer funds to Connected Account"""
+    """Process successful charge and transfer funds to the Connected Account(s)"""
     charge = event["data"]["object"]
     charge_id = charge["id"]
-    amount = charge["amount"]
     
     # Idempotency check
     if charge_id in processed_charges:
         logger.info(f"Charge {charge_id} already processed, skipping")
         return
     
+    transfer_with_lease(charge_id, lambda renew_lease: _transfer_charge(charge, renew_lease))
+
+def transfer_with_lease(
+    charge_id: str,
+    work: Callable[[Optional[Callable[[], None]]], bool]
+) -> bool:
+    """
+    Run work(renew_lease) while owning the charge's transfer lease, and record
+    the charge as completed cluster-wide when work returns True.
+    
+    Returns:
+        True if the charge is completed (by this call or earlier, on any worker)
+    
+    Raises:
+        LeaseHeldError: if another worker currently owns the charge
+    """
+    # Claim the charge so only one worker in the cluster transfers it
+    lease_key = transfer_lease_key(charge_id)
+    owner = lease_owner()
+    try:
+        lease_state, lease_remaining = coordination_store.acquire(
+            lease_key, owner, TRANSFER_LEASE_SECONDS
+        )
+    except Exception as e:
+        # Fall back to Stripe idempotency keys alone
+        logger.error(f"Coordination store unavailable for {charge_id}: {e}")
+        lease_state, lease_remaining = "unavailable", 0
+    
+    if lease_state == "completed":
+        logger.info(f"Charge {charge_id} already processed by another worker, skipping")
+        processed_charges.add(charge_id)
+        return True
+    if lease_state == "held":
+        raise LeaseHeldError(lease_key, max(1, math.ceil(lease_remaining)))
+    
+    def renew_lease() -> None:
+        try:
+            if not coordination_store.renew(lease_key, owner, TRANSFER_LEASE_SECONDS):
+                logger.error(f"Lost lease {lease_key} while transferring {charge_id}")
+        except Exception as e:
+            logger.error(f"Failed to renew lease {lease_key}: {e}")
+    
+    completed = False
+    try:
+        completed = work(renew_lease if lease_state == "acquired" else None)
+    finally:
+        if lease_state == "acquired":
+            try:
+                coordination_store.release(lease_key, owner, completed=completed)
+            except Exception as e:
+                logger.error(f"Failed to release lease {lease_key}: {e}")
+    if completed:
+        processed_charges.add(charge_id)
+    return completed
+
+def _transfer_charge(
+    charge: Dict[str, Any],
+    renew_lease: Optional[Callable[[], None]] = None
+) -> bool:
+    """
+    Calculate fees and issue all transfer legs for a charge.
+    
+    Args:
+        charge: Captured charge
+        renew_lease: Called periodically while legs are in flight
+    
+    Returns:
+        True if every leg was transferred
+    """
+    charge_id = charge["id"]
+    amount = charge["amount"]
+    
     # Calculate fees
     try:
         fees = calculate_fees(amount)
     except Exception as e:
         logger.error(f"Fee calculation failed for charge {charge_id}: {e}")
-        return
+        return False
     
-    logger.info(
-        f"Processing charge {charge_id}: "
-        f"Amount=${amount/100:.2f}, "
-        f"Stripe Fee=${fees['stripe_fee']/100:.2f}, "
-        f"Platform Commission=${fees['platform_commission']/100:.2f}, "
-        f"Transfer=${fees['transfer_amount']/100:.2f}"
-    )
-    
-    # Create transfer to Connected Account
+    # Divide the net amount across destinations
     try:
-        transfer = stripe.Transfer.create(
-            amount=fees["transfer_amount"],
-            currency="usd",
-            destination=CONNECTED_ACCOUNT_ID,
-            source_transaction=charge_id,
-            metadata={
-                "initiated_by": "Ursus",
-                "platform": PLATFORM_NAME,
-                "connected": CONNECTED_NAME,
-                "original_amount": amount,
-                "stripe_fee": fees["stripe_fee"],
-                "platform_commission": fees["platform_commission"]
-            },
-            idempotency_key=f"transfer_{charge_id}"
+        legs = allocate_splits(fees["transfer_amount"], get_split_rules(charge))
+    except ValueError as e:
+        # Park the whole net amount until the rules are fixed and redriven
+        logger.error(f"Invalid split rules for charge {charge_id}: {e}")
+        record_dead_letter(
+            charge, fees, "", fees["transfer_amount"], split_dead_letter_key(charge_id), e
         )
-        
+        return False
+    
+    with trace_span("log"):
+        logger.info(
+            f"Processing charge {charge_id}: "
+            f"Amount=${amount/100:.2f}, "
+            f"Stripe Fee=${fees['stripe_fee']/100:.2f}, "
+            f"Platform Commission=${fees['platform_commission']/100:.2f}, "
+            f"Transfer=${fees['transfer_amount']/100:.2f} "
+            f"({len(legs)} destination{'s' if len(legs) != 1 else ''})"
+        )
+    
+    # Issue all legs concurrently; each leg has its own idempotency key
+    futures = [
+        transfer_pool.submit(
+            contextvars.copy_context().run,
+            transfer_leg, charge, fees, destination, leg_amount,
+            transfer_idempotency_key(charge_id, leg, len(legs), destination)
+        )
+        for leg, (destination, leg_amount) in enumerate(legs, start=1)
+    ]
+    pending = set(futures)
+    while pending:
+        _, pending = wait(pending, timeout=TRANSFER_LEASE_RENEW_SECONDS)
+        if pending and renew_lease is not None:
+            renew_lease()
+    results = [future.exception() or future.result() for future in futures]
+    
+    circuit_errors = [result for result in results if isinstance(result, CircuitOpenError)]
+    if circuit_errors:
+        raise circuit_errors[0]
+    
+    if all(result is True for result in results):
         # Mark as processed
         processed_charges.add(charge_id)
+        return True
+    return False
+
+@profiled("transfer_leg")
+def transfer_leg(
+    charge: Dict[str, Any],
+    fees: Dict[str, int],
+    destination: str,
+    transfer_amount: int,
+    idempotency_key: str
+) -> bool:
+    """
+    Create one transfer leg, dead-lettering it on failure.
+    
+    Returns:
+        True if the transfer exists (created now or earlier)
+    """
+    charge_id = charge["id"]
+    name = CONNECTED_NAME if destination == CONNECTED_ACCOUNT_ID else destination
+    try:
+        transfer = create_transfer(
+            charge_id, charge["amount"], fees, destination, transfer_amount, idempotency_key
+        )
         
         logger.info(
             f"✓ Transfer {transfer.id} completed: "
-            f"${fees['transfer_amount']/100:.2f} → {CONNECTED_NAME}"
+            f"${transfer_amount/100:.2f} → {name}"
         )
+        return True
         
     except stripe.error.InvalidRequestError as e:
         # Check if transfer already exists
         if "already been transferred" in str(e).lower():
-            logger.warning(f"Transfer already exists for charge {charge_id}")
-            processed_charges.add(charge_id)
-        else:
-            logger.error(f"Invalid transfer request for {charge_id}: {e}")
+            logger.warning(f"Transfer already exists for charge {charge_id} → {name}")
+            return True
+        logger.error(f"Invalid transfer request for {charge_id} → {name}: {e}")
+        record_dead_letter(charge, fees, destination, transfer_amount, idempotency_key, e)
+    
+    except CircuitOpenError:
+        raise
     
     except stripe.error.StripeError as e:
-        logger.error(f"Stripe error during transfer for {charge_id}: {e}")
+        logger.error(f"Stripe error during transfer for {charge_id} → {name}: {e}")
+        record_dead_letter(charge, fees, destination, transfer_amount, idempotency_key, e)
+    
+    except Exception as e:
+        logger.exception(f"Unexpected error transferring funds for {charge_id} → {name}: {e}")
+        record_dead_letter(charge, fees, destination, transfer_amount, idempotency_key, e)
+    
+    return False
+
+def create_transfer(
+    charge_id: str,
+    amount: int,
+    fees: Dict[str, int],
+    destination: str,
+    transfer_amount: int,
+    idempotency_key: str
+) -> Any:
+    """Transfer part of a charge's net amount to a Connected Account"""
+    return stripe_call(
+        stripe.Transfer.create,
+        amount=transfer_amount,
+        currency="usd",
+        destination=destination,
+        source_transaction=charge_id,
+        transfer_group=transfer_group(charge_id),
+        metadata={
+            "initiated_by": "Ursus",
+            "platform": PLATFORM_NAME,
+            "connected": CONNECTED_NAME if destination == CONNECTED_ACCOUNT_ID else destination,
+            "original_amount": amount,
+            "stripe_fee": fees["stripe_fee"],
+            "platform_commission": fees["platform_commission"],
+            "transfer_key": idempotency_key
+        },
+        idempotency_key=idempotency_key
+    )
+
+def transfer_group(charge_id: str) -> str:
+    """Transfer group shared by all legs of a charge (used to find them again)"""
+    return f"ursus_{charge_id}"
+
+def find_existing_transfer(entry: Dict[str, Any]) -> Any:
+    """
+    Look up a transfer that may already exist for a dead-lettered leg.
+    
+    Stripe forgets idempotency keys after 24 hours, and a timed-out request
+    may have succeeded, so a redrive must check before creating again.
+    Transfers are found through the charge's transfer group; older ones
+    without a group are searched for among transfers to the destination
+    created while the entry was being attempted.
+    """
+    transfers = stripe_list(
+        stripe.Transfer, transfer_group=transfer_group(entry["charge_id"]), limit=100
+    )
+    transfer = _match_existing_transfer(entry, transfers)
+    if transfer is not None:
+        return transfer
+    transfers = stripe_list(
+        stripe.Transfer,
+        destination=entry["destination"],
+        created={
+            "gte": int(entry["created_at"]) - DEAD_LETTER_LOOKUP_MARGIN_SECONDS,
+            "lte": int(entry["updated_at"]) + DEAD_LETTER_LOOKUP_MARGIN_SECONDS
+        },
+        limit=100
+    )
+    return _match_existing_transfer(entry, transfers)
+
+def _match_existing_transfer(entry: Dict[str, Any], transfers: Iterable) -> Any:
+    """Transfer matching the entry's transfer_key, or its charge and amount"""
+    for transfer in transfers:
+        source = transfer.get("source_transaction")
+        if isinstance(source, dict):
+            source = source.get("id")
+        if source != entry["charge_id"]:
+            continue
+        if transfer.get("destination") not in (None, entry["destination"]):
+            continue
+        transfer_key = (transfer.get("metadata") or {}).get("transfer_key")
+        if transfer_key == entry["idempotency_key"]:
+            return transfer
+        if transfer_key is None and transfer["amount"] == entry["transfer_amount"]:
+            return transfer
+    return None
+
+# ====================================================
+#  Dead-Letter Store for Failed Transfers
+# ====================================================
+# Transfers that fail in handle_charge_succeeded are recorded here (keyed by
+# the transfer's idempotency key) so they can be listed and redriven later.
+# Entries are removed once a redrive succeeds. A charge whose split rules
+# are invalid is parked whole under split_dead_letter_key() (no destination)
+# and split again from its current rules when redriven.
+DEAD_LETTER_MAX_CONCURRENCY = int(os.getenv("DEAD_LETTER_MAX_CONCURRENCY", "8"))
+DEAD_LETTER_MAX_REDRIVE = 1000  # entries per redrive request
+# Slack around an entry's attempts when searching for transfers without a
+# transfer group (clock skew, slow requests)
+DEAD_LETTER_LOOKUP_MARGIN_SECONDS = 600
+
+_STATE_SCHEMA.append("""
+    CREATE TABLE IF NOT EXISTS dead_letters (
+        idempotency_key TEXT PRIMARY KEY,
+        charge_id TEXT NOT NULL,
+        destination TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        transfer_amount INTEGER NOT NULL,
+        fees TEXT NOT NULL,
+        error_type TEXT NOT NULL,
+        error TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 1,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+""")
+_STATE_SCHEMA.append(
+    "CREATE INDEX IF NOT EXISTS dead_letters_charge_id ON dead_letters (charge_id)"
+)
+
+def record_dead_letter(
+    charge: Dict[str, Any],
+    fees: Dict[str, int],
+    destination: str,
+    transfer_amount: int,
+    idempotency_key: str,
+    error: Exception
+) -> None:
+    """Persist a failed transfer leg (repeated failures increment attempts)"""
+    charge_id = charge["id"]
+    now = time.time()
+    try:
+        get_state_db().execute(
+            "INSERT INTO dead_letters (idempotency_key, charge_id, destination, amount, "
+            "transfer_amount, fees, error_type, error, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (idempotency_key) DO UPDATE SET "
+            "error_type = excluded.error_type, error = excluded.error, "
+            "attempts = attempts + 1, updated_at = excluded.updated_at",
+            (
+                idempotency_key, charge_id, destination, charge["amount"],
+                transfer_amount, json.dumps(fees), type(error).__name__,
+                str(error)[:1000], now, now
+            )
+        )
+        logger.warning(f"Transfer {idempotency_key} added to dead-letter store")
+    except sqlite3.Error as e:
+        logger.critical(f"Failed to record dead letter for {charge_id}: {e} (transfer error: {error})")
+
+def list_dead_letters(
+    charge_id: Optional[str] = None,
+    error_type: Optional[str] = None,
+    since: Optional[float] = None,
+    limit: int = 100
+) -> List[Dict[str, Any]]:
+    """Return dead letters (oldest first), optionally filtered"""
+    clauses, params = [], []
+    if charge_id:
+        clauses.append("charge_id = ?")
+        params.append(charge_id)
+    if error_type:
+        clauses.append("error_type = ?")
+        params.append(error_type)
+    if since is not None:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    
+    cursor = get_state_db().execute(
+        f"SELECT * FROM dead_letters {where} ORDER BY created_at LIMIT ?",
+        params + [limit]
+    )
+    columns = [column[0] for column in cursor.description]
+    entries = []
+    for row in cursor:
+        entry = dict(zip(columns, row))
+        entry["fees"] = json.loads(entry["fees"])
+        entries.append(entry)
+    return entries
+
+def _redrive_charge(charge_id: str, entries: List[Dict[str, Any]]) -> List[str]:
+    """
+    Redrive all selected entries of one charge under its charge lock and
+    transfer lease, like a webhook delivery, so redrives never race a
+    redelivery on another worker or node.
+    
+    Returns:
+        One outcome per entry
+    """
+    db = get_state_db()
+    outcomes: Dict[str, str] = {}
+    
+    def work(renew_lease: Optional[Callable[[], None]]) -> bool:
+        for index, entry in enumerate(entries):
+            if index and renew_lease is not None:
+                renew_lease()
+            if entry["idempotency_key"] == split_dead_letter_key(charge_id):
+                outcome = _redrive_split(db, entry, renew_lease)
+            else:
+                outcome = _redrive_leg(db, entry)
+            outcomes[entry["idempotency_key"]] = outcome
+        # The charge is done once none of its legs are left in the store
+        remaining = db.execute(
+            "SELECT COUNT(*) FROM dead_letters WHERE charge_id = ?", (charge_id,)
+        ).fetchone()[0]
+        return remaining == 0
     
+    try:
+        if charge_already_transferred(charge_id):
+            completed = True
+        else:
+            with charge_lock(charge_id):
+                completed = transfer_with_lease(charge_id, work)
+    except (LeaseHeldError, ChargeBusyError) as e:
+        logger.info(f"Skipping redrive of {charge_id}: {e}")
+        return ["skipped"] * len(entries)
+    
+    if completed and not outcomes:
+        # Every leg went through on a redelivery; the entries are stale
+        logger.info(f"Charge {charge_id} already transferred, clearing its dead letters")
+        db.execute("DELETE FROM dead_letters WHERE charge_id = ?", (charge_id,))
+        return ["succeeded"] * len(entries)
+    return [outcomes.get(entry["idempotency_key"], "skipped") for entry in entries]
+
+def _redrive_leg(db: sqlite3.Connection, entry: Dict[str, Any]) -> str:
+    """Recreate one dead-lettered transfer leg unless it already exists"""
+    charge_id = entry["charge_id"]
+    try:
+        transfer = find_existing_transfer(entry)
+        if transfer is not None:
+            logger.warning(f"Transfer {transfer['id']} already exists for {entry['idempotency_key']}")
+        else:
+            transfer = create_transfer(
+                charge_id, entry["amount"], entry["fees"], entry["destination"],
+                entry["transfer_amount"], entry["idempotency_key"]
+            )
+            logger.info(f"✓ Redrive transfer {transfer.id} completed for {entry['idempotency_key']}")
+    except CircuitOpenError:
+        return "skipped"
+    except stripe.error.InvalidRequestError as e:
+        if "already been transferred" not in str(e).lower():
+            return _redrive_failed(db, entry, e)
+        logger.warning(f"Transfer already exists for {entry['idempotency_key']}")
     except Exception as e:
-        logger.exception(f"Unexpected error transferring funds for {charge_id}: {e}")
+        return _redrive_failed(db, entry, e)
+    
+    db.execute(
+        "DELETE FROM dead_letters WHERE idempotency_key = ?", (entry["idempotency_key"],)
+    )
+    return "succeeded"
+
+def _redrive_split(
+    db: sqlite3.Connection,
+    entry: Dict[str, Any],
+    renew_lease: Optional[Callable[[], None]]
+) -> str:
+    """
+    Redrive a charge that was never split: re-read its (possibly corrected)
+    rules and issue every leg. Legs that fail are dead-lettered on their own.
+    """
+    charge_id = entry["charge_id"]
+    try:
+        charge = stripe_call(stripe.Charge.retrieve, charge_id)
+        charge_cache.put(charge_id, charge)
+        # Same inputs as _transfer_charge, so the legs below will allocate too
+        allocate_splits(calculate_fees(charge["amount"])["transfer_amount"], get_split_rules(charge))
+    except CircuitOpenError:
+        return "skipped"
+    except Exception as e:
+        return _redrive_failed(db, entry, e)
+    
+    try:
+        completed = _transfer_charge(charge, renew_lease)
+    except CircuitOpenError:
+        return "skipped"
+    db.execute(
+        "DELETE FROM dead_letters WHERE idempotency_key = ?", (entry["idempotency_key"],)
+    )
+    if not completed:
+        logger.error(f"Redrive of {charge_id} left failed legs in the dead-letter store")
+        return "failed"
+    logger.info(f"✓ Redrive split and transferred charge {charge_id}")
+    return "succeeded"
+
+def _redrive_failed(db: sqlite3.Connection, entry: Dict[str, Any], error: Exception) -> str:
+    logger.error(f"Redrive failed for {entry['charge_id']}: {error}")
+    db.execute(
+        "UPDATE dead_letters SET error_type = ?, error = ?, attempts = attempts + 1, "
+        "updated_at = ? WHERE idempotency_key = ?",
+        (type(error).__name__, str(error)[:1000], time.time(), entry["idempotency_key"])
+    )
+    return "failed"
+
+def redrive_dead_letters(entries: List[Dict[str, Any]], concurrency: int = 4) -> Dict[str, Any]:
+    """
+    Retry dead-lettered transfers on a bounded thread pool, one charge at a
+    time per thread.
+    
+    Returns:
+        Counts of succeeded / failed / skipped (circuit open, or charge owned
+        by another worker) entries
+    """
+    concurrency = max(1, min(concurrency, DEAD_LETTER_MAX_CONCURRENCY))
+    summary = {"total": len(entries), "succeeded": 0, "failed": 0, "skipped": 0}
+    if not entries:
+        return summary
+    
+    logger.info(f"Redriving {len(entries)} dead-lettered transfers (concurrency {concurrency})")
+    by_charge: Dict[str, List[Dict[str, Any]]] = {}
+    for entry in entries:
+        by_charge.setdefault(entry["charge_id"], []).append(entry)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="redrive") as pool:
+        for outcomes in pool.map(_redrive_charge, by_charge, by_charge.values()):
+            for outcome in outcomes:
+                summary[outcome] += 1
+    return summary
+
+@app.route("/dead-letters", methods=["GET"])
+@require_api_key
+def get_dead_letters() -> Tuple[Response, int]:
+    """
+    List failed transfers.
+    
+    Query Parameters:
+        charge_id: (optional) Filter by charge
+        error_type: (optional) Filter by exception name, e.g. APIConnectionError
+        since: (optional) Unix timestamp of the earliest failure
+        limit: (optional) Maximum entries (default 100)
+    """
+    try:
+        since = request.args.get("since")
+        entries = list_dead_letters(
+            charge_id=request.args.get("charge_id"),
+            error_type=request.args.get("error_type"),
+            since=float(since) if since else None,
+            limit=int(request.args.get("limit", 100))
+        )
+    except ValueError:
+        return jsonify({"error": "Invalid 'since' or 'limit'"}), 400
+    return jsonify({"count": len(entries), "dead_letters": entries}), 200
+
+@app.route("/dead-letters/redrive", methods=["POST"])
+@require_api_key
+def post_dead_letters_redrive() -> Tuple[Response, int]:
+    """
+    Redrive failed transfers.
+    
+    JSON Body (all optional):
+        charge_ids: List of charges to redrive (default: all matching filters)
+        error_type: Only entries that failed with this exception name
+        limit: Maximum entries to redrive (default 100, at most 1000)
+        concurrency: Parallel transfers (default 4)
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        limit = int(data.get("limit", 100))
+        concurrency = int(data.get("concurrency", 4))
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid 'limit' or 'concurrency'"}), 400
+    if limit < 1:
+        return jsonify({"error": "Invalid 'limit' or 'concurrency'"}), 400
+    limit = min(limit, DEAD_LETTER_MAX_REDRIVE)
+    
+    charge_ids = data.get("charge_ids")
+    if charge_ids is not None and (
+        not isinstance(charge_ids, list)
+        or not all(isinstance(charge_id, str) for charge_id in charge_ids)
+    ):
+        return jsonify({"error": "'charge_ids' must be a list of charge IDs"}), 400
+    
+    if charge_ids:
+        entries = []
+        for charge_id in charge_ids:
+            entries.extend(list_dead_letters(
+                charge_id=charge_id,
+                error_type=data.get("error_type"),
+                limit=limit - len(entries)
+            ))
+            if len(entries) >= limit:
+                break
+    else:
+        entries = list_dead_letters(error_type=data.get("error_type"), limit=limit)
+    
+    return jsonify(redrive_dead_letters(entries, concurrency)), 200
 
 # ====================================================
 #  Charge Refund Handler
@@ -517,23 +2340,279 @@ def handle_charge_refunded(event: Dict[str, Any]) -> None:
 @app.route("/health", methods=["GET"])
 def health_check() -> Tuple[Response, int]:
     """Health check endpoint for monitoring"""
+    breaker = breaker_status()
+    if "retry_after" in breaker:
+        return jsonify({
+            "status": "unhealthy",
+            "error": "Stripe circuit breaker open",
+            "circuit_breaker": breaker
+        }), 503, {"Retry-After": str(breaker["retry_after"])}
+    
     try:
         # Verify Stripe connectivity
-        stripe.Account.retrieve(CONNECTED_ACCOUNT_ID)
+        stripe_call(stripe.Account.retrieve, CONNECTED_ACCOUNT_ID)
         
         return jsonify({
             "status": "healthy",
             "timestamp": datetime.utcnow().isoformat(),
             "environment": FLASK_ENV,
-            "stripe_connected": True
+            "stripe_connected": True,
+            "circuit_breaker": breaker
         }), 200
+    except CircuitOpenError as e:
+        # Breaker tripped or a half-open probe is in flight
+        return jsonify({
+            "status": "unhealthy",
+            "error": "Stripe circuit breaker open",
+            "circuit_breaker": breaker_status()
+        }), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.error(f"Health check failed: {e}")
         return jsonify({
             "status": "unhealthy",
-            "error": "Stripe connectivity issue"
+            "error": "Stripe connectivity issue",
+            "circuit_breaker": breaker_status()
         }), 503
 
+# ====================================================
+#  Settlement Report Export
+# ====================================================
+# Streams charges and transfers for a date range (newest first, via SDK
+# auto-pagination) and joins them on source_transaction. Transfers are
+# buffered only while they can still match an upcoming charge, i.e. for
+# SETTLEMENT_JOIN_WINDOW after the charge, so memory does not grow with the
+# size of the range. Both listings are fetched concurrently on background
+# threads with a bounded number of prefetched pages; every page goes through
+# the circuit breaker.
+#
+# The HTTP status is sent before the listing finishes, so every report ends
+# with a trailer record: "complete", or "error" if a page could not be
+# fetched. A report without a "complete" trailer is truncated.
+SETTLEMENT_PAGE_SIZE = 100  # Stripe list maximum
+SETTLEMENT_PREFETCH_PAGES = int(os.getenv("SETTLEMENT_PREFETCH_PAGES", "4"))
+SETTLEMENT_JOIN_WINDOW = int(os.getenv("SETTLEMENT_JOIN_WINDOW_HOURS", "24")) * 3600
+
+SETTLEMENT_FIELDS = [
+    "record", "date", "charge_id", "transfer_id", "currency", "charges",
+    "gross", "stripe_fee", "platform_commission", "transfer_amount", "error"
+]
+SETTLEMENT_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+def prefetch(iterable: Iterable, max_items: int) -> Iterator:
+    """Consume an iterable on a background thread, buffering at most max_items"""
+    buffer = queue.Queue(maxsize=max_items)
+    stop = threading.Event()
+    done = object()
+    
+    def put(entry) -> bool:
+        # Timed puts so an abandoned consumer never blocks the producer forever
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+    
+    threading.Thread(
+        target=contextvars.copy_context().run, args=(produce,),
+        name="settlement-prefetch", daemon=True
+    ).start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # Unblock the producer if the consumer stops early
+        stop.set()
+
+def _list_created_between(resource, start_ts: int, end_ts: int) -> Iterator:
+    return prefetch(
+        stripe_list(
+            resource, created={"gte": start_ts, "lt": end_ts}, limit=SETTLEMENT_PAGE_SIZE
+        ),
+        SETTLEMENT_PREFETCH_PAGES * SETTLEMENT_PAGE_SIZE
+    )
+
+def _new_rollup(date: str, currency: str) -> Dict[str, Any]:
+    return {
+        "record": "day", "date": date, "charge_id": "", "transfer_id": "",
+        "currency": currency, "charges": 0, "gross": 0, "stripe_fee": 0,
+        "platform_commission": 0, "transfer_amount": 0, "error": ""
+    }
+
+def iter_settlement_records(start_ts: int, end_ts: int) -> Iterator[Dict[str, Any]]:
+    """
+    Yield one "charge" record per captured charge created in [start_ts, end_ts),
+    followed by a "day" rollup record whenever a UTC day (per currency) is complete.
+    """
+    charges = _list_created_between(stripe.Charge, start_ts, end_ts)
+    # Transfers for late charges in the range may be created after end_ts
+    transfers = _list_created_between(
+        stripe.Transfer, start_ts, end_ts + SETTLEMENT_JOIN_WINDOW
+    )
+    
+    pending_transfer = next(transfers, None)
+    buffered: Dict[str, List[Any]] = {}
+    buffered_order = deque()  # (created, charge_id), newest first
+    rollups: Dict[str, Dict[str, Any]] = {}
+    current_date = None
+    
+    for charge in charges:
+        if charge.get("status") != "succeeded" or not charge.get("captured", False):
+            continue
+        created = charge["created"]
+        
+        # Buffer every transfer created at or after this charge
+        while pending_transfer is not None and pending_transfer["created"] >= created:
+            source = pending_transfer.get("source_transaction")
+            if isinstance(source, dict):
+                source = source.get("id")
+            if source:
+                buffered.setdefault(source, []).append(pending_transfer)
+                buffered_order.append((pending_transfer["created"], source))
+            pending_transfer = next(transfers, None)
+        
+        # Drop transfers too far ahead to belong to this or any older charge
+        while buffered_order and buffered_order[0][0] > created + SETTLEMENT_JOIN_WINDOW:
+            _, source = buffered_order.popleft()
+            if source in buffered:
+                buffered[source].pop(0)
+                if not buffered[source]:
+                    del buffered[source]
+        
+        date = datetime.utcfromtimestamp(created).strftime("%Y-%m-%d")
+        if date != current_date:
+            yield from rollups.values()
+            rollups = {}
+            current_date = date
+        
+        matched = buffered.pop(charge["id"], [])
+        fees = calculate_fees(charge["amount"])
+        metadata = matched[0].get("metadata", {}) if matched else {}
+        record = {
+            "record": "charge",
+            "date": date,
+            "charge_id": charge["id"],
+            "transfer_id": ";".join(transfer["id"] for transfer in matched),
+            "currency": charge["currency"],
+            "charges": 1,
+            "gross": charge["amount"],
+            "stripe_fee": int(metadata.get("stripe_fee", fees["stripe_fee"])),
+            "platform_commission": int(
+                metadata.get("platform_commission", fees["platform_commission"])
+            ),
+            "transfer_amount": sum(transfer["amount"] for transfer in matched),
+            "error": ""
+        }
+        yield record
+        
+        rollup = rollups.setdefault(record["currency"], _new_rollup(date, record["currency"]))
+        for field in ("charges", "gross", "stripe_fee", "platform_commission", "transfer_amount"):
+            rollup[field] += record[field]
+    
+    yield from rollups.values()
+
+def iter_settlement_report(start_ts: int, end_ts: int) -> Iterator[Dict[str, Any]]:
+    """
+    iter_settlement_records() followed by a trailer record: "complete", or
+    "error" (with the exception) if the listing failed part way through.
+    """
+    trailer = dict(_new_rollup("", ""), record="complete")
+    try:
+        for record in iter_settlement_records(start_ts, end_ts):
+            if record["record"] == "charge":
+                trailer["charges"] += 1
+            yield record
+    except Exception as e:
+        logger.error(f"Settlement report aborted after {trailer['charges']} charges: {e}")
+        trailer.update(record="error", error=f"{type(e).__name__}: {e}")
+    yield trailer
+
+def iter_settlement_lines(records: Iterable[Dict[str, Any]], fmt: str) -> Iterator[str]:
+    """Serialize settlement records incrementally as CSV or JSONL"""
+    if fmt == "jsonl":
+        for record in records:
+            yield json.dumps(record) + "\n"
+        return
+    
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=SETTLEMENT_FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def parse_report_range(start: Optional[str], end: Optional[str]) -> Tuple[int, int]:
+    """
+    Convert inclusive YYYY-MM-DD dates (UTC) into a [start, end) timestamp range.
+    
+    Raises:
+        ValueError: if a date is missing or invalid
+    """
+    if not start or not end:
+        raise ValueError("Both 'start' and 'end' dates are required (YYYY-MM-DD)")
+    start_dt = datetime.strptime(start, "%Y-%m-%d")
+    end_dt = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1)
+    if end_dt <= start_dt:
+        raise ValueError("'end' must not be before 'start'")
+    epoch = datetime(1970, 1, 1)
+    return int((start_dt - epoch).total_seconds()), int((end_dt - epoch).total_seconds())
+
+@app.route("/reports/settlements", methods=["GET"])
+@require_api_key
+def settlement_report() -> Response:
+    """
+    Stream a settlement report.
+    
+    Query Parameters:
+        start: First day (YYYY-MM-DD, UTC)
+        end: Last day, inclusive (YYYY-MM-DD, UTC)
+        format: csv (default) or jsonl
+    
+    The last record is "complete" or, if Stripe failed mid-report, "error".
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in SETTLEMENT_FORMATS:
+        return jsonify({"error": "Invalid format (csv or jsonl)"}), 400
+    try:
+        start_ts, end_ts = parse_report_range(request.args.get("start"), request.args.get("end"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    logger.info(f"Settlement report requested: {request.args.get('start')} to {request.args.get('end')}")
+    lines = iter_settlement_lines(iter_settlement_report(start_ts, end_ts), fmt)
+    return Response(stream_with_context(lines), mimetype=SETTLEMENT_FORMATS[fmt])
+
+# ====================================================
+#  Metrics Endpoint
+# ====================================================
+@app.route("/metrics", methods=["GET"])
+@require_api_key
+def metrics() -> Tuple[Response, int]:
+    """Internal processing metrics for this worker process"""
+    return jsonify({
+        "pid": os.getpid(),
+        "admission": admission.stats(),
+        "webhook_partitions": webhook_dispatcher.stats()
+    }), 200
+
 # ====================================================
 #  Root Endpoint
 # ====================================================
@@ -0,0 +1,180 @@
+"""
+====================================================
+    URSUS - Command Line Tools
+
+    Usage:
+        python cli.py export-settlements --start 2026-09-01 --end 2026-09-30
+        python cli.py export-settlements --start 2026-09-01 --end 2026-09-30 \
+            --format jsonl --output september.jsonl
+        python cli.py dead-letters list --error-type APIConnectionError
+        python cli.py dead-letters redrive --concurrency 4
+        python cli.py simulate-fees --charges charges.csv --schedules schedules.json
+
+    Uses the same .env configuration as app.py.
+====================================================
+"""
+
+import argparse
+import json
+import os
+import sys
+
+
+def export_settlements(args: argparse.Namespace) -> int:
+    """Write a settlement report to a file or stdout"""
+    from app import iter_settlement_lines, iter_settlement_report, parse_report_range
+
+    try:
+        start_ts, end_ts = parse_report_range(args.start, args.end)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    trailer = {}
+
+    def records():
+        for record in iter_settlement_report(start_ts, end_ts):
+            if record["record"] in ("complete", "error"):
+                trailer.update(record)
+            yield record
+
+    if args.output == "-":
+        for line in iter_settlement_lines(records(), args.format):
+            sys.stdout.write(line)
+    else:
+        # Write next to the target and rename only once the report is complete
+        partial = f"{args.output}.partial"
+        try:
+            with open(partial, "w", newline="") as f:
+                for line in iter_settlement_lines(records(), args.format):
+                    f.write(line)
+            if trailer.get("record") == "complete":
+                os.replace(partial, args.output)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    if trailer.get("record") != "complete":
+        print(f"Error: settlement report incomplete ({trailer.get('error')})", file=sys.stderr)
+        return 1
+    if args.output != "-":
+        print(f"Settlement report written to {args.output}", file=sys.stderr)
+    return 0
+
+
+def dead_letters(args: argparse.Namespace) -> int:
+    """List or redrive failed transfers"""
+    from app import list_dead_letters, redrive_dead_letters
+
+    entries = list_dead_letters(
+        charge_id=args.charge_id,
+        error_type=args.error_type,
+        since=args.since,
+        limit=args.limit
+    )
+    if args.action == "list":
+        for entry in entries:
+            print(json.dumps(entry))
+        print(f"{len(entries)} dead-lettered transfers", file=sys.stderr)
+        return 0
+
+    summary = redrive_dead_letters(entries, args.concurrency)
+    print(json.dumps(summary))
+    return 0 if summary["failed"] == 0 and summary["skipped"] == 0 else 1
+
+
+def simulate_fees(args: argparse.Namespace) -> int:
+    """Compare fee schedules over historical charges"""
+    import time
+
+    import numpy as np
+
+    from app import (
+        PLATFORM_COMMISSION_PERCENT, STRIPE_FEE_FIXED, STRIPE_FEE_PERCENT, calculate_fees
+    )
+    from fee_simulation import compute_fees, load_charges, load_schedules, simulate
+
+    defaults = {
+        "stripe_fee_percent": STRIPE_FEE_PERCENT,
+        "stripe_fee_fixed": STRIPE_FEE_FIXED,
+        "platform_commission_percent": PLATFORM_COMMISSION_PERCENT
+    }
+    # The configured schedule is always the baseline for revenue deltas
+    schedules = load_schedules(args.schedules) if args.schedules else []
+    current = [schedule for schedule in schedules if schedule.get("name") == "current"]
+    if current:
+        # The file brings its own baseline; simulate it first, once
+        schedules = current[:1] + [schedule for schedule in schedules if schedule is not current[0]]
+    else:
+        schedules = [{"name": "current"}] + schedules
+
+    started = time.monotonic()
+    amounts, currency_codes, currency_names = load_charges(args.charges)
+    loaded = time.monotonic()
+
+    # Cross-check the vectorized math against calculate_fees() on a sample
+    if args.verify and len(amounts):
+        sample = np.random.default_rng().choice(len(amounts), min(args.verify, len(amounts)), replace=False)
+        sample_amounts = np.asarray(amounts[sample], dtype=np.int64)
+        fees = compute_fees(
+            sample_amounts, np.zeros(len(sample), dtype=np.int16), ["usd"], {}, defaults
+        )
+        for index, amount in enumerate(sample_amounts.tolist()):
+            expected = calculate_fees(amount)
+            for field in ("stripe_fee", "platform_commission", "transfer_amount"):
+                if int(fees[field][index]) != expected[field]:
+                    print(f"Error: simulation differs from calculate_fees for amount {amount}", file=sys.stderr)
+                    return 1
+
+    results = simulate(amounts, currency_codes, currency_names, schedules, defaults)
+    for result in results:
+        print(json.dumps(result))
+    print(
+        f"{len(amounts)} charges, {len(schedules)} schedules "
+        f"(load {loaded - started:.2f}s, simulate {time.monotonic() - loaded:.2f}s)",
+        file=sys.stderr
+    )
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="URSUS command line tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser(
+        "export-settlements",
+        help="Export gross, fees, commission and transfers per charge and per day"
+    )
+    export.add_argument("--start", required=True, help="First day (YYYY-MM-DD, UTC)")
+    export.add_argument("--end", required=True, help="Last day, inclusive (YYYY-MM-DD, UTC)")
+    export.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    export.add_argument("--output", "-o", default="-", help="Output file (default: stdout)")
+    export.set_defaults(func=export_settlements)
+
+    dead = subparsers.add_parser("dead-letters", help="List or redrive failed transfers")
+    dead.add_argument("action", choices=["list", "redrive"])
+    dead.add_argument("--charge-id", help="Only this charge")
+    dead.add_argument("--error-type", help="Only this exception name, e.g. APIConnectionError")
+    dead.add_argument("--since", type=float, help="Only failures after this Unix timestamp")
+    dead.add_argument("--limit", type=int, default=100)
+    dead.add_argument("--concurrency", type=int, default=4, help="Parallel transfers for redrive")
+    dead.set_defaults(func=dead_letters)
+
+    sim = subparsers.add_parser(
+        "simulate-fees",
+        help="Replay candidate fee schedules over historical charges (requires numpy)"
+    )
+    sim.add_argument("--charges", required=True, help="Charges file (.csv, .parquet or .npy)")
+    sim.add_argument("--schedules", help="JSON file with candidate schedules")
+    sim.add_argument(
+        "--verify", type=int, default=1000,
+        help="Sample size checked against calculate_fees() (0 to skip)"
+    )
+    sim.set_defaults(func=simulate_fees)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -169,11 +169,12 @@ Group=ursus
 WorkingDirectory=/home/ursus/ursus
 Environment="PATH=/home/ursus/ursus/venv/bin"
 Environment="FLASK_ENV=production"
+Environment="WORKER_THREADS=4"
 
 ExecStart=/home/ursus/ursus/venv/bin/gunicorn \
     --bind 127.0.0.1:4242 \
     --workers 4 \
-    --threads 2 \
+    --threads ${WORKER_THREADS} \
     --worker-class sync \
     --timeout 30 \
     --max-requests 1000 \
@@ -0,0 +1,309 @@
+"""
+====================================================
+    URSUS - Fee Schedule Simulation
+
+    Replays candidate fee schedules over historical charge amounts with
+    vectorized NumPy integer math that reproduces calculate_fees() in
+    app.py exactly (Decimal multiply, truncation toward zero).
+
+    Input: CSV with an "amount" column (cents) and optional "currency"
+    column, Parquet with the same columns, or a .npy array of amounts.
+    CSV input is converted once to .npy files next to the source and
+    memory-mapped on later runs.
+
+    Requires NumPy (and PyArrow for Parquet input).
+====================================================
+"""
+
+import csv
+import json
+import os
+from array import array
+from decimal import Decimal
+from typing import Tuple, Dict, Any, List
+
+import numpy as np
+
+# Rows processed per vectorized step (bounds memory for very large inputs)
+SIMULATION_CHUNK_ROWS = 1_000_000
+
+# Largest amount * numerator product that still fits comfortably in int64
+_MAX_PRODUCT = 2 ** 62
+
+SCHEDULE_FIELDS = ("stripe_fee_percent", "stripe_fee_fixed", "platform_commission_percent")
+
+
+# ====================================================
+#  Loading Historical Charges
+# ====================================================
+def _csv_cache_paths(path: str) -> Tuple[str, str, str]:
+    return f"{path}.amounts.npy", f"{path}.currencies.npy", f"{path}.currencies.json"
+
+
+def _convert_csv(path: str) -> None:
+    """Convert a charges CSV into memory-mappable .npy files"""
+    amounts_path, codes_path, names_path = _csv_cache_paths(path)
+    amounts = array("q")
+    codes = array("h")
+    currencies: Dict[str, int] = {}
+
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        if "amount" not in (reader.fieldnames or []):
+            raise ValueError(f"{path} has no 'amount' column")
+        for row in reader:
+            amounts.append(int(row["amount"]))
+            currency = (row.get("currency") or "usd").lower()
+            codes.append(currencies.setdefault(currency, len(currencies)))
+
+    np.save(amounts_path, np.frombuffer(amounts, dtype=np.int64))
+    np.save(codes_path, np.frombuffer(codes, dtype=np.int16))
+    with open(names_path, "w") as f:
+        json.dump(sorted(currencies, key=currencies.get), f)
+
+
+def load_charges(path: str) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """
+    Load historical charges.
+
+    Returns:
+        (amounts, currency_codes, currency_names) where currency_codes
+        indexes currency_names
+    """
+    if path.endswith(".npy"):
+        amounts = np.load(path, mmap_mode="r")
+        return amounts, np.zeros(len(amounts), dtype=np.int16), ["usd"]
+
+    if path.endswith(".parquet"):
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        import pyarrow as pa
+
+        # Only the needed columns are read; compressed pages are still
+        # decoded into memory, unlike the memory-mapped .npy/CSV caches
+        schema = pq.read_schema(path)
+        if "amount" not in schema.names:
+            raise ValueError(f"{path} has no 'amount' column")
+        amount_type = schema.field("amount").type
+        if not pa.types.is_integer(amount_type):
+            # Never truncate fractional amounts silently
+            raise ValueError(f"{path} 'amount' must be integer cents, not {amount_type}")
+        columns = [name for name in ("amount", "currency") if name in schema.names]
+        table = pq.read_table(path, columns=columns)
+        amount_column = table.column("amount")
+        if amount_column.null_count:
+            raise ValueError(f"{path} has {amount_column.null_count} rows with no amount")
+        amounts = amount_column.to_numpy().astype(np.int64, copy=False)
+        if "currency" not in table.column_names:
+            return amounts, np.zeros(len(amounts), dtype=np.int16), ["usd"]
+        # Lowercase before encoding so "USD" and "usd" share one code
+        currencies = pc.utf8_lower(table.column("currency").combine_chunks()).fill_null("usd")
+        encoded = currencies.dictionary_encode()
+        names = encoded.dictionary.to_pylist()
+        return amounts, encoded.indices.to_numpy().astype(np.int16), names
+
+    amounts_path, codes_path, names_path = _csv_cache_paths(path)
+    if not os.path.exists(names_path) or os.path.getmtime(names_path) < os.path.getmtime(path):
+        _convert_csv(path)
+    with open(names_path) as f:
+        names = json.load(f)
+    return np.load(amounts_path, mmap_mode="r"), np.load(codes_path, mmap_mode="r"), names
+
+
+# ====================================================
+#  Fee Schedules
+# ====================================================
+def _ratio(value: Any) -> Tuple[int, int]:
+    numerator, denominator = Decimal(str(value)).as_integer_ratio()
+    if numerator < 0:
+        raise ValueError(f"Negative rate {value}")
+    return numerator, denominator
+
+
+def _resolve_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "stripe_fee": _ratio(params["stripe_fee_percent"]),
+        "stripe_fee_fixed": int(params["stripe_fee_fixed"]),
+        "platform_commission": _ratio(params["platform_commission_percent"]),
+    }
+
+
+def _overrides(source: Dict[str, Any]) -> Dict[str, Any]:
+    return {field: source[field] for field in SCHEDULE_FIELDS if field in source}
+
+
+def schedule_params(
+    schedule: Dict[str, Any],
+    defaults: Dict[str, Any],
+    currency: str,
+    tier: int
+) -> Dict[str, Any]:
+    """
+    Effective parameters for one currency and tier.
+
+    Precedence: defaults < schedule < schedule["currencies"][currency]
+    < schedule["tiers"][tier] (tiers sorted by min_amount).
+    """
+    params = dict(defaults)
+    params.update(_overrides(schedule))
+    params.update(_overrides(schedule.get("currencies", {}).get(currency, {})))
+    if tier >= 0:
+        params.update(_overrides(_sorted_tiers(schedule)[tier]))
+    return _resolve_params(params)
+
+
+def _sorted_tiers(schedule: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return sorted(schedule.get("tiers", []), key=lambda tier: int(tier["min_amount"]))
+
+
+# ====================================================
+#  Vectorized Fee Calculation
+# ====================================================
+def _truncated_rate(values: np.ndarray, numerator: np.ndarray, denominator: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    int(Decimal(value) * rate) for every value, plus the exact remainder
+    (as a numerator over denominator) that truncation discarded.
+    """
+    magnitude = np.abs(values) * numerator
+    quotient = magnitude // denominator
+    remainder = magnitude - quotient * denominator
+    sign = np.sign(values)
+    return sign * quotient, sign * remainder
+
+
+def compute_fees(
+    amounts: np.ndarray,
+    currency_codes: np.ndarray,
+    currency_names: List[str],
+    schedule: Dict[str, Any],
+    defaults: Dict[str, Any]
+) -> Dict[str, np.ndarray]:
+    """
+    Vectorized calculate_fees() for one schedule.
+
+    Returns:
+        Arrays of stripe_fee, platform_commission, transfer_amount,
+        net_after_stripe, plus the fractional cents discarded by rounding
+        (stripe_fee_drift, commission_drift)
+    """
+    amounts = np.asarray(amounts, dtype=np.int64)
+    tiers = _sorted_tiers(schedule)
+    tier_index = np.full(len(amounts), -1, dtype=np.int64)
+    for index, tier in enumerate(tiers):
+        tier_index[amounts >= int(tier["min_amount"])] = index
+
+    fee_num = np.empty(len(amounts), dtype=np.int64)
+    fee_den = np.empty(len(amounts), dtype=np.int64)
+    fee_fixed = np.empty(len(amounts), dtype=np.int64)
+    commission_num = np.empty(len(amounts), dtype=np.int64)
+    commission_den = np.empty(len(amounts), dtype=np.int64)
+
+    max_amount = int(np.abs(amounts).max()) if len(amounts) else 0
+    for code, currency in enumerate(currency_names):
+        currency_mask = currency_codes == code
+        if not currency_mask.any():
+            continue
+        for tier in range(-1, len(tiers)):
+            mask = currency_mask & (tier_index == tier)
+            if not mask.any():
+                continue
+            params = schedule_params(schedule, defaults, currency, tier)
+            for numerator, _ in (params["stripe_fee"], params["platform_commission"]):
+                if numerator * max(max_amount, 1) >= _MAX_PRODUCT:
+                    raise ValueError(f"Rate too precise for int64 math in schedule {schedule.get('name')}")
+            fee_num[mask], fee_den[mask] = params["stripe_fee"]
+            fee_fixed[mask] = params["stripe_fee_fixed"]
+            commission_num[mask], commission_den[mask] = params["platform_commission"]
+
+    stripe_fee_variable, fee_remainder = _truncated_rate(amounts, fee_num, fee_den)
+    stripe_fee = stripe_fee_variable + fee_fixed
+    net_after_stripe = amounts - stripe_fee
+    platform_commission, commission_remainder = _truncated_rate(
+        net_after_stripe, commission_num, commission_den
+    )
+
+    return {
+        "stripe_fee": stripe_fee,
+        "platform_commission": platform_commission,
+        "transfer_amount": net_after_stripe - platform_commission,
+        "net_after_stripe": net_after_stripe,
+        "stripe_fee_drift": fee_remainder / fee_den,
+        "commission_drift": commission_remainder / commission_den,
+    }
+
+
+# ====================================================
+#  Simulation
+# ====================================================
+def simulate(
+    amounts: np.ndarray,
+    currency_codes: np.ndarray,
+    currency_names: List[str],
+    schedules: List[Dict[str, Any]],
+    defaults: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """
+    Apply every schedule to all charges, chunk by chunk.
+
+    Returns:
+        One result per schedule and currency with totals in cents, the
+        rounding drift (cents discarded by truncation) for Stripe fees and
+        platform commission, and the platform revenue change relative to
+        the first schedule
+    """
+    totals: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    for start in range(0, len(amounts), SIMULATION_CHUNK_ROWS):
+        chunk_amounts = np.asarray(amounts[start:start + SIMULATION_CHUNK_ROWS], dtype=np.int64)
+        chunk_codes = np.asarray(currency_codes[start:start + SIMULATION_CHUNK_ROWS])
+        masks = {int(code): chunk_codes == code for code in np.unique(chunk_codes)}
+        for schedule_index, schedule in enumerate(schedules):
+            fees = compute_fees(chunk_amounts, chunk_codes, currency_names, schedule, defaults)
+            for code, mask in masks.items():
+                result = totals.setdefault((schedule_index, code), {
+                    "schedule": schedule.get("name", f"schedule-{schedule_index + 1}"),
+                    "currency": currency_names[code],
+                    "charges": 0,
+                    "gross": 0,
+                    "stripe_fee": 0,
+                    "platform_revenue": 0,
+                    "vendor_payouts": 0,
+                    "stripe_fee_drift": 0.0,
+                    "commission_drift": 0.0,
+                })
+                result["charges"] += int(mask.sum())
+                result["gross"] += int(chunk_amounts[mask].sum())
+                result["stripe_fee"] += int(fees["stripe_fee"][mask].sum())
+                result["platform_revenue"] += int(fees["platform_commission"][mask].sum())
+                result["vendor_payouts"] += int(fees["transfer_amount"][mask].sum())
+                result["stripe_fee_drift"] += float(fees["stripe_fee_drift"][mask].sum())
+                result["commission_drift"] += float(fees["commission_drift"][mask].sum())
+
+    results = []
+    for schedule_index, code in sorted(totals):
+        result = totals[(schedule_index, code)]
+        result["stripe_fee_drift"] = round(result["stripe_fee_drift"], 4)
+        result["commission_drift"] = round(result["commission_drift"], 4)
+        result["revenue_delta"] = result["platform_revenue"] - totals[(0, code)]["platform_revenue"]
+        results.append(result)
+    return results
+
+
+def load_schedules(path: str) -> List[Dict[str, Any]]:
+    """
+    Load candidate schedules from JSON, e.g.:
+
+        [{"name": "commission-1.5", "platform_commission_percent": "0.015",
+          "tiers": [{"min_amount": 100000, "platform_commission_percent": "0.01"}],
+          "currencies": {"eur": {"stripe_fee_percent": "0.025", "stripe_fee_fixed": 25}}}]
+
+    Fields left out fall back to the values configured in app.py. The
+    configured schedule itself is always simulated first as "current".
+    """
+    with open(path) as f:
+        schedules = json.load(f)
+    if isinstance(schedules, dict):
+        schedules = [schedules]
+    if not isinstance(schedules, list) or not schedules:
+        raise ValueError("Schedule file must contain a schedule or a list of schedules")
+    return schedules